@@ -1,16 +1,16 @@
 import os
 from fastsam import FastSAM, FastSAMPrompt
-import matplotlib.pyplot as plt
 import argparse
 from utils.tools import convert_box_xywh_to_xyxy
+from mask_io import write_mask_png
 import ast
-from PIL import Image
 import numpy as np
+import torch
 import logging
 import sys
 from pathlib import Path
 
-def parse_args():
+def parse_args(argv=None):
     global args
     parser = argparse.ArgumentParser(prog='MIMUL FastSAM', description='Implements FastSAM for use on MIMUL Piano Roll heads.')
     parser.add_argument('-d', '--device', type=str,  required=False, default='cpu', help='The computing device to work on. To work on graphics card use \'CUDA\', default is \'cpu\'')
@@ -21,9 +21,10 @@ def parse_args():
     parser.add_argument('-m', '--mode', type=str, required=True, default='box', help='The mode to use for manually marking the location of the label or licence stamp. For box mode type \'box\'. for points mode use \'points\'.')
     parser.add_argument('-b', '--box', type=str, required=False, help='The box of the label or stamp. Requires format like in FastSAM: bbox default shape [0,0,0,0] -> [x1,y1,x2,y2] Example: box = [[1692, 882, 440, 508]]')
     parser.add_argument('-p', '--points', type=str, required=False, help='The points of the label or stamp. Requires format like in FastSAM. points default shapes: single point: [[0,0]] multiple points: [[x1,y1],[x2,y2]]')
+    parser.add_argument('-pi', '--prompted_inference', action='store_true', help='Select the masks for the box or points already at the low resolution of the mask prototypes and only upsample those to the full image size, instead of every mask found in the image.')
     parser.add_argument('-pl', '--point_labels', type=str, required=False, help='The point_label to define which points belong to the foreground and which belong to the background. Requires format like in FastSAM: point_label default [0] [1,0] 0:background, 1:foreground')
    
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     # print(f'args={args}')
 
     print(f'Image to be processed: {args.input}')
@@ -40,6 +41,7 @@ def parse_args():
         parser.error('Points mode requires the --points argument')
     elif(args.mode == 'points' and args.point_labels == None):
         parser.error('Points mode requires the --point_labels argument')
+    return args
 
 def setup_logging():
 
@@ -62,20 +64,35 @@ def setup_logging():
     except Exception as e:
         print(f"Error while trying to start logging. Error: {e}")
 
-def main():
+def load_model():
+    return FastSAM('./weights/FastSAM-x.pt')
 
-    model = FastSAM('./weights/FastSAM-x.pt')
+def main(args, model=None):
+
+    if model is None:
+        model = load_model()
     image_path = f'{args.input_output_directory}/{args.manufacturer}/Input/{args.input}.jpg'
     output_path = Path(args.input_output_directory) / args.manufacturer / 'Outputs' / args.target / 'FastSAM results' / args.mode
     # DEVICE = 'CUDA' or 'cpu'
-    logging.info('Generating everything results.')
-    everything_results = model(image_path, device=args.device, retina_masks=True, imgsz=1024, conf=0.4, iou=0.9,)
+    if args.mode == 'box':
+        # one or several boxes [x1,y1,x2,y2] per row
+        bboxes = args.box if isinstance(args.box[0], list) else [list(args.box)]
+    prompts = {}
+    if args.prompted_inference and args.mode == 'box':
+        prompts = {'bboxes': bboxes}
+    elif args.prompted_inference and args.mode == 'points':
+        prompts = {'points': list(args.points)}
+    if prompts:
+        logging.info('Generating prompted results.')
+    else:
+        logging.info('Generating everything results.')
+    everything_results = model(image_path, device=args.device, retina_masks=True, imgsz=1024, conf=0.4, iou=0.9, **prompts)
     prompt_process = FastSAMPrompt(image_path, everything_results, device=args.device)
     # output_path = Path(output_path)
 
     if args.mode=='box': 
         # bbox default shape [0,0,0,0] -> [x1,y1,x2,y2]
-        ann = prompt_process.box_prompt(bbox=list(args.box))   
+        ann = prompt_process.box_prompt(bboxes=bboxes)
 
     if args.mode=='points':
         # point prompt
@@ -84,7 +101,7 @@ def main():
         ann = prompt_process.point_prompt(points=list(args.points), pointlabel=list(args.point_labels))
 
 
-    save_mask(ann,output_path)
+    save_mask(args, ann, output_path)
 
     #save reference image
     os.makedirs(Path(output_path / 'Images'), exist_ok=True)
@@ -92,7 +109,7 @@ def main():
     prompt_process.plot(annotations=ann, output_path=f'{output_path}/Images/{args.input}.jpg',withContours=True)
 
 
-def save_mask(ann, output_path):
+def save_mask(args, ann, output_path):
     # path preparations
     try:
         masks_path = output_path / 'Masks'    
@@ -104,41 +121,36 @@ def save_mask(ann, output_path):
         logging.error(f"Unexpected error in FastSAM. Error: {e}")
         raise Exception(f"Unexpected error in FastSAM: {e}")
 
-    for i, mask in enumerate(ann):
+    masks = []
+    for mask in ann:
         if isinstance(mask, dict):
             mask = mask['segmentation']
-        try:
-            logging.info(f"saving annotations mask {i} to folder {output_path}/Masks/")
-            mask_file = masks_path / f'{args.input}.png'            
-            plt.imsave(mask_file, mask)
-            plt.close()
-
-            with Image.open(mask_file) as image:
-                image_data = np.array(image)
-                image = Image.fromarray(replace_colors(image_data))
-                image.save(mask_file)
-        except FileNotFoundError as fnfe:
-            logging.error(f"Error while trying to create or access the mask file(s). Error: {fnfe}")
-            raise Exception(f"FileNotFoundError in FastSAM: {fnfe}")
-        except PermissionError as pe:
-            logging.error(f"Error with permissions of the mask file(s). Error: {pe}")
-            raise Exception(f"PermissionError in FastSAM: {pe}")
-        except Exception as e:
-            logging.error(f"Error while replacing the masks colors. Error: {e}")
-            raise Exception(f"Error while replacing the masks colors. Error: {e}")
-
-def replace_colors(image_data):
-    replacement_specs = [((68, 1, 84), (0, 0, 0)), ((253, 231, 36), (128, 0, 0))]
-    for (r1, g1, b1), (r2, g2, b2) in replacement_specs:
-        mask = (image_data[:,:,0] == r1) & (image_data[:,:,1] == g1) & (image_data[:,:,2] == b1)
-        image_data[:,:,:3][mask] = [r2, g2, b2]
-    return image_data
+        if isinstance(mask, torch.Tensor):
+            mask = mask.cpu().numpy()
+        masks.append(mask > 0)
+    if len(masks) == 0:
+        logging.warning(f"No mask found for {args.input}. Nothing saved.")
+        return
+    try:
+        # several boxes on one row end up in one mask
+        logging.info(f"saving {len(masks)} annotation mask(s) to folder {output_path}/Masks/")
+        mask_file = masks_path / f'{args.input}.png'
+        write_mask_png(mask_file, np.logical_or.reduce(masks))
+    except FileNotFoundError as fnfe:
+        logging.error(f"Error while trying to create or access the mask file(s). Error: {fnfe}")
+        raise Exception(f"FileNotFoundError in FastSAM: {fnfe}")
+    except PermissionError as pe:
+        logging.error(f"Error with permissions of the mask file(s). Error: {pe}")
+        raise Exception(f"PermissionError in FastSAM: {pe}")
+    except Exception as e:
+        logging.error(f"Error while writing the mask file. Error: {e}")
+        raise Exception(f"Error while writing the mask file. Error: {e}")
 
 if __name__ == "__main__":
     try:
         parse_args()
         setup_logging()
-        main()
+        main(args)
     except Exception as e:
         logging.error(f"Unforseen error occured at FastSAM (step 1). FastSAM terminated. Error: {e}")
         sys.exit(1)
\ No newline at end of file
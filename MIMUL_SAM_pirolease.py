@@ -1,18 +1,48 @@
 import argparse
 import csv
 import subprocess
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import nullcontext
 import eval_mIoU_MIMUL
+from state_store import StateStore
 import logging
 from pathlib import Path
+import queue
 import sys
+import threading
+
+# Models kept resident for the whole run when --in_process is set
+fastsam_model = None
+sam_predictors = None
+sam_lock = threading.Lock()
+# SAM predictors of the model workers in batch mode
+predictor_pool = queue.Queue()
 
 def parse_args():
     global args
     parser = argparse.ArgumentParser(prog='MIMUL FastSAM', description='Joins FastSAM and PerSAM for segmenting MIMUL piano roll leads.')
     parser.add_argument('-d', '--device', type=str,  required=False, default='cpu', help='The computing device to work on. To work on graphics card use \'CUDA\', default is \'cpu\'')
     parser.add_argument('-io', '--input_output_directory', type=str, required=True, help='Path to the working directory with inputs and outpus.')
-    parser.add_argument('-ma', '--manufacturer', type=str, required=True, help='The piano roll manufacturer.')  
+    parser.add_argument('-ma', '--manufacturer', type=str, required=False, help='The piano roll manufacturer. Required unless --batch_manufacturers is used.')  
+    parser.add_argument('-w', '--weights_directory', type=str, required=False, default='./weights/', help='Directory of the SAM checkpoints.')
     parser.add_argument('-c', '--ckpt', type=str, required=False, default='sam_vit_h_4b8939.pth', help='Needed if another checkpoint shall be used.')
+    parser.add_argument('-mt', '--model_type', type=str, required=False, choices=['vit_h', 'vit_l', 'vit_b', 'vit_t'], help='The SAM model of the checkpoint for PerSAM and PerSAM_F. \'vit_t\' is MobileSAM (-c mobile_sam.pt), much faster than vit_h. By default it is guessed from the checkpoint name.')
+    parser.add_argument('-ec', '--embedding_cache', type=str, required=False, help='Directory for cached SAM image embeddings, handed to PerSAM and PerSAM_F. Every image is then only encoded once per checkpoint, across targets, steps and reruns.')
+    parser.add_argument('-eb', '--encoder_batch_size', type=int, required=False, default=1, help='Number of test images PerSAM and PerSAM_F encode in one pass of the SAM image encoder.')
+    parser.add_argument('-vi', '--verification_images', type=str, required=False, default='on', choices=['on', 'off', 'deferred'], help='Verification images of PerSAM and PerSAM_F. \'deferred\' draws them after all masks of a step are found, \'off\' skips them.')
+    parser.add_argument('-lt', '--loader_threads', type=int, required=False, default=2, help='Number of background threads PerSAM and PerSAM_F use to decode and resize the next test images while the encoder works.')
+    parser.add_argument('-rd', '--reduced_decode', type=str, required=False, default='on', choices=['on', 'off'], help='Let PerSAM and PerSAM_F decode large JPEGs at reduced resolution, as long as they stay larger than the encoder input. \'off\' always decodes the full resolution.')
+    parser.add_argument('-im', '--inference_mode', type=str, required=False, default='fp32', choices=['fp32', 'int8', 'bf16'], help='Precision of the SAM image encoder in PerSAM and PerSAM_F. \'int8\' and \'bf16\' are much faster on the CPU, \'int8\' only works with -d cpu.')
+    parser.add_argument('-cc', '--cascade_ckpt', type=str, required=False, help='Checkpoint of a fast screening model for PerSAM and PerSAM_F, e.g. \'mobile_sam.pt\'. Every test image is segmented with it first and only the uncertain masks are found again with --ckpt.')
+    parser.add_argument('-cs', '--cascade_score', type=float, required=False, default=0.9, help='Masks of the screening model with a lower IoU prediction of the SAM decoder are found again with --ckpt.')
+    parser.add_argument('-cp', '--cascade_peak', type=float, required=False, default=4.0, help='Masks of the screening model whose similarity peak stands out less, in standard deviations of the map, are found again with --ckpt.')
+    parser.add_argument('-ar', '--all_references', action='store_true', help='Run PerSAM and PerSAM_F for all pending CSV rows of a target at once, in this process. Every test image is then encoded once and compared against all reference targets in one pass.')
+    parser.add_argument('-pi', '--prompted_inference', action='store_true', help='Let FastSAM only upsample the masks that can answer the box or points prompt to full resolution. Saves a lot of memory on large scans.')
+    parser.add_argument('-ew', '--evaluation_workers', type=int, required=False, default=1, help='Number of processes that evaluate the CSV rows in step 4 in parallel. The overall results do not depend on it.')
+    parser.add_argument('-pp', '--pipelined', action='store_true', help='Run the steps of different CSV rows at the same time. PerSAM starts for a row as soon as its FastSAM mask exists, instead of waiting for step 1 to finish for all rows.')
+    parser.add_argument('-bm', '--batch_manufacturers', type=str, nargs='*', required=False, help='Run all target CSVs of these manufacturers in one batch. Without names every manufacturer folder in the input and output directory is used. PerSAM and PerSAM_F then run once per manufacturer for the rows of all its targets, so every test image is encoded once for all targets.')
+    parser.add_argument('-mw', '--model_workers', type=int, required=False, default=1, help='Number of SAM models working on different manufacturers at the same time in batch mode. Every worker loads its own model.')
+    parser.add_argument('-ip', '--in_process', action='store_true', help='Run FastSAM, PerSAM and PerSAM_F inside this process instead of one subprocess per CSV row. FastSAM and SAM are loaded only once for the whole run.')
     
     parser.add_argument('-man', '--manual', type=bool, required=False, help='Override flag for manual mode: ID, target and mode need to be provided with arguments. CSV will be ignored.')
     parser.add_argument('-t', '--target', type=str, required=False, help='The object that should be segmented.')
@@ -26,6 +56,10 @@ def parse_args():
         args = parser.parse_args()
     except argparse.ArgumentError as aae:
          print(f"Error parsing arguments: {aae}")
+    if args.manufacturer is None and args.batch_manufacturers is None:
+        parser.error('--manufacturer is required unless --batch_manufacturers is used')
+    if args.device == "CUDA" and args.inference_mode == 'int8':
+        parser.error('--inference_mode int8 only works on the CPU')
 
 def setup_logging(new_path=None, target=None):
     if new_path == None:
@@ -71,25 +105,36 @@ def main():
     try:
         if (args.manual):
             logging.info("Manual mode is not implemented yet.")
+        elif args.batch_manufacturers is not None:
+            batch_segmentation()
         else:
-            csv_input_folder = Path(f'{args.input_output_directory}/{args.manufacturer}/Input/CSV')
-            csv_output_folder = Path(f'{args.input_output_directory}/{args.manufacturer}/Outputs/CSV')
-            for csv_file in csv_input_folder.iterdir():
-                if csv_file.suffix.lower() == '.csv':
-                    target = csv_file.stem
-                    csv_output = Path(csv_output_folder, f'{target}.csv')
-                    if not csv_output_folder.exists():
-                        try:
-                            csv_output_folder.mkdir(parents=True, exist_ok=True)
-                        except OSError as ose:
-                            logging.error (f"Error creating directories {csv_output_folder}. Error: {ose}") 
-                    csv_segmentation(csv_file, csv_output, target)
-                else:
-                    logging.warning (f'The file {csv_file} is not a CSV-file. Please only put CSV-files into the CSV input folder.')
+            store, target_csvs = find_target_csvs()
+            for csv_file, csv_output, target in target_csvs:
+                csv_segmentation(store, csv_file, csv_output, target)
     except Exception as e:
         logging.error (f"An unexpected error occurred in MIMUL_SAM_pirolese. Error: {e}")      
 
-def csv_segmentation(csv_input_path, csv_output_path, target):
+def find_target_csvs():
+    # The state store and the target CSVs of args.manufacturer
+    csv_input_folder = Path(f'{args.input_output_directory}/{args.manufacturer}/Input/CSV')
+    csv_output_folder = Path(f'{args.input_output_directory}/{args.manufacturer}/Outputs/CSV')
+    try:
+        csv_output_folder.mkdir(parents=True, exist_ok=True)
+    except OSError as ose:
+        logging.error (f"Error creating directories {csv_output_folder}. Error: {ose}") 
+    # Step status of all targets, the CSVs are exported from it after every target
+    store = StateStore(csv_output_folder / 'pirolease_state.sqlite')
+    target_csvs = []
+    for csv_file in csv_input_folder.iterdir():
+        if csv_file.suffix.lower() == '.csv':
+            target = csv_file.stem
+            csv_output = Path(csv_output_folder, f'{target}.csv')
+            target_csvs.append((csv_file, csv_output, target))
+        else:
+            logging.warning (f'The file {csv_file} is not a CSV-file. Please only put CSV-files into the CSV input folder.')
+    return store, target_csvs
+
+def csv_segmentation(store, csv_input_path, csv_output_path, target):
 
     logging.info (f"Found CSV for target {target}.")
     logging.info (f"Input and Outputs directory set to {args.input_output_directory}")
@@ -97,134 +142,285 @@ def csv_segmentation(csv_input_path, csv_output_path, target):
 
     setup_logging(f"{args.input_output_directory}/{args.manufacturer}/Outputs/{target}", target)
 
-    logging.info (f"\nStep 1: Segmenting target {target} with FastSAM")
+    if not load_csv(store, csv_input_path, target):
+        return
+
     try:
-        with open(csv_input_path, newline='', encoding='utf-8-sig') as instructions_csv:
-            instructions_reader = csv.DictReader(instructions_csv, dialect='excel', delimiter=';')
-            with open(csv_output_path, 'w', newline='', encoding='utf-8-sig') as resumption_csv:
-                resumption_writer = csv.DictWriter(resumption_csv, fieldnames=instructions_reader.fieldnames, dialect='excel', delimiter=';')
-                resumption_writer.writeheader()
-            for image_row in instructions_reader:
-                if image_row['done'] == '' or image_row['done'] == None:
-                    result = fastSAM(target, image_row)
-                    if result.returncode == 0:
-                        image_row['done'] = 1
-                else:
-                    logging.info (f"Step 1 already done for image {image_row['image']}, skipped.")
-                with open(csv_output_path, 'a', newline='', encoding='utf-8-sig') as resumption_csv:
-                    resumption_writer = csv.DictWriter(resumption_csv, fieldnames=instructions_reader.fieldnames, dialect='excel', delimiter=';')
-                    resumption_writer.writerow(image_row)
-        try:
-            csv_output_path.replace(csv_input_path)
-        except PermissionError as pe:
-            logging.error(f"Error with permission when trying to rename the file: {pe}")
+        if args.pipelined and not args.all_references:
+            segment_rows_pipelined(store, target)
+        else:
+            if args.pipelined:
+                logging.warning ("--pipelined can not be combined with --all_references, running the steps one after another.")
+            segment_rows(store, target)
+    finally:
+        export_csv(store, csv_input_path, csv_output_path, target)
+
+def load_csv(store, csv_input_path, target):
+    try:
+        if store.load_csv(target, csv_input_path):
+            logging.info (f"Read {csv_input_path} into the state store.")
+        else:
+            logging.info (f"{csv_input_path} is unchanged since the last run, resuming from the state store.")
+        return True
     except FileNotFoundError as fnfe:
         logging.error(f"CSV file {csv_input_path} could not be found. Error: {fnfe}")
     except IOError as ioe:
         logging.error(f"I/O error while trying to read CSV file {csv_input_path}. Error: {ioe}")
     except Exception as e: 
         logging.error (f"Unexpected error while trying to read CSV file: {e}")
+    return False
+
+def export_csv(store, csv_input_path, csv_output_path, target):
+    try:
+        store.export_csv(target, csv_input_path, csv_output_path)
+    except PermissionError as pe:
+        logging.error(f"Error with permission when trying to write the CSV file: {pe}")
+    except Exception as e:
+        logging.error (f"Unexpected error while trying to write CSV file {csv_input_path}: {e}")
+
+def batch_segmentation():
+    # All targets of all manufacturers in one run. FastSAM and the evaluation run per target as usual,
+    # PerSAM and PerSAM_F run once per manufacturer for the pending rows of all its targets, spread
+    # over --model_workers SAM models.
+    import PerSAM_MIMUL
+    import PerSAM_F_MIMUL
+
+    manufacturers = args.batch_manufacturers
+    if not manufacturers:
+        manufacturers = sorted(folder.name for folder in Path(args.input_output_directory).iterdir() if (folder / 'Input' / 'CSV').is_dir())
+    logging.info (f"Batch mode for manufacturers {manufacturers}")
+
+    batch = []
+    for manufacturer in manufacturers:
+        args.manufacturer = manufacturer
+        store, target_csvs = find_target_csvs()
+        for csv_file, csv_output, target in target_csvs:
+            setup_logging(f"{args.input_output_directory}/{manufacturer}/Outputs/{target}", target)
+            if load_csv(store, csv_file, target):
+                fastSAM_rows(store, target)
+                batch.append((manufacturer, store, csv_file, csv_output, target))
+
+    logging.info (f"\nSteps 2 and 3 for {len(batch)} targets with {args.model_workers} model workers.")
+    # PerSAM and PerSAM_F are separate jobs, so a failure of one keeps the finished step of the other.
+    # All PerSAM jobs are queued first, PerSAM_F then finds the embeddings of PerSAM in the cache.
+    persam_jobs, persam_f_jobs = [], []
+    for manufacturer in manufacturers:
+        args.manufacturer = manufacturer
+        persam_rows, persam_f_rows, persam_args, persam_f_args = [], [], [], []
+        for _, store, _, _, target in (entry for entry in batch if entry[0] == manufacturer):
+            for i, image_row in enumerate(store.rows(target)):
+                if done_step(image_row) <= 1:
+                    persam_rows.append((store, target, i))
+                    persam_args.append(PerSAM_MIMUL.parse_args(reference_arguments(target, image_row)))
+                if done_step(image_row) <= 2:
+                    persam_f_rows.append((store, target, i))
+                    persam_f_args.append(PerSAM_F_MIMUL.parse_args(reference_arguments(target, image_row)))
+        if persam_rows:
+            persam_jobs.append((PerSAM_MIMUL.main_references, persam_args, manufacturer, 'PerSAM', persam_rows, 2))
+        if persam_f_rows:
+            persam_f_jobs.append((PerSAM_F_MIMUL.main_references, persam_f_args, manufacturer, 'PerSAM_F', persam_f_rows, 3))
+
+    with ThreadPoolExecutor(max_workers=args.model_workers) as executor:
+        futures = {}
+        for function, references, *job in persam_jobs + persam_f_jobs:
+            futures[executor.submit(run_with_pooled_predictor, function, references)] = job
+
+        # Rows whose step 2 failed stay pending for step 2, also if their step 3 succeeded
+        failed_rows = set()
+        for future, (manufacturer, step_name, rows, done) in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logging.error (f"Unexpected error while running {step_name} for manufacturer {manufacturer}. Error: {e}")
+                failed_rows.update(rows)
+                continue
+            for store, target, i in rows:
+                if (store, target, i) not in failed_rows:
+                    store.update(target, i, done=done)
+
+    for manufacturer, store, csv_file, csv_output, target in batch:
+        args.manufacturer = manufacturer
+        setup_logging(f"{args.input_output_directory}/{manufacturer}/Outputs/{target}", target)
+        try:
+            eval_rows(store, target)
+        finally:
+            export_csv(store, csv_file, csv_output, target)
+
+def run_with_pooled_predictor(function, *arguments):
+    # Every model worker takes its SAM predictors from the pool, so at most --model_workers are loaded
+    try:
+        predictors = predictor_pool.get_nowait()
+    except queue.Empty:
+        logging.info (f"Loading SAM checkpoint {args.ckpt} for a model worker.")
+        predictors = load_sam_predictors()
+    try:
+        return function(*arguments, *predictors)
+    finally:
+        predictor_pool.put(predictors)
+
+def segment_rows(store, target):
+    fastSAM_rows(store, target)
+    perSAM_rows(store, target)
+    perSAM_F_rows(store, target)
+    eval_rows(store, target)
 
+def fastSAM_rows(store, target):
+
+    logging.info (f"\nStep 1: Segmenting target {target} with FastSAM")
+    try:
+        for i, image_row in enumerate(store.rows(target)):
+            if image_row['done'] == '' or image_row['done'] == None:
+                result = fastSAM(target, image_row)
+                if result.returncode == 0:
+                    store.update(target, i, done=1)
+            else:
+                logging.info (f"Step 1 already done for image {image_row['image']}, skipped.")
+    except Exception as e: 
+        logging.error (f"Unexpected error in step 1: {e}")
+
+def perSAM_rows(store, target):
 
     logging.info ("\nStep 2: Using FastSAM masks for PerSAM extraction")
     try:
-        with open(csv_input_path, newline='', encoding='utf-8-sig') as instructions_csv:
-            instructions_reader = csv.DictReader(instructions_csv, dialect='excel', delimiter=';')
-            with open(csv_output_path, 'w', newline='', encoding='utf-8-sig') as resumption_csv:
-                resumption_writer = csv.DictWriter(resumption_csv, fieldnames=instructions_reader.fieldnames, dialect='excel', delimiter=';')
-                resumption_writer.writeheader()
-            for image_row in instructions_reader:
-                if image_row['done'] == '' or int(image_row['done']) <= 1:
+        image_rows = store.rows(target)
+        pending_rows = [i for i, image_row in enumerate(image_rows) if image_row['done'] == '' or int(image_row['done']) <= 1]
+        if args.all_references and pending_rows:
+            perSAM_references(target, [image_rows[i] for i in pending_rows])
+        for i, image_row in enumerate(image_rows):
+            if i in pending_rows:
+                if not args.all_references:
                     perSAM(target, image_row)
-                    image_row['done'] = 2
-                else:
-                    logging.info (f"Step 2 already done for image {image_row['image']}, skipped.")
-                with open(csv_output_path, 'a', newline='', encoding='utf-8-sig') as resumption_csv:
-                    resumption_writer = csv.DictWriter(resumption_csv, fieldnames=instructions_reader.fieldnames, dialect='excel', delimiter=';')
-                    resumption_writer.writerow(image_row)
-        try:
-            csv_output_path.replace(csv_input_path)
-        except PermissionError as pe:
-            logging.error(f"Error with permission when trying to rename the file: {pe}")
-    except FileNotFoundError as fnfe:
-        logging.error(f"CSV file {csv_input_path} could not be found. Error: {fnfe}")
-    except IOError as ioe:
-        logging.error(f"I/O error while trying to read CSV file {csv_input_path}. Error: {ioe}")
+                store.update(target, i, done=2)
+            else:
+                logging.info (f"Step 2 already done for image {image_row['image']}, skipped.")
     except Exception as e: 
-        logging.error (f"Unexpected error while trying to read CSV file: {e}")
+        logging.error (f"Unexpected error in step 2: {e}")
+
+def perSAM_F_rows(store, target):
 
     logging.info ("\nStep 3: Using FastSAM masks for PerSAM_f extraction (with some training).")
     try:
-        with open(csv_input_path, newline='', encoding='utf-8-sig') as instructions_csv:
-            instructions_reader = csv.DictReader(instructions_csv, dialect='excel', delimiter=';')
-            with open(csv_output_path, 'w', newline='', encoding='utf-8-sig') as resumption_csv:
-                resumption_writer = csv.DictWriter(resumption_csv, fieldnames=instructions_reader.fieldnames, dialect='excel', delimiter=';')
-                resumption_writer.writeheader()
-            for image_row in instructions_reader:
-                if image_row['done'] == '' or int(image_row['done']) <= 2:
+        image_rows = store.rows(target)
+        pending_rows = [i for i, image_row in enumerate(image_rows) if image_row['done'] == '' or int(image_row['done']) <= 2]
+        if args.all_references and pending_rows:
+            perSAM_F_references(target, [image_rows[i] for i in pending_rows])
+        for i, image_row in enumerate(image_rows):
+            if i in pending_rows:
+                if not args.all_references:
                     perSAM_F(target, image_row)
-                    image_row['done'] = 3
-                else:
-                    logging.info (f"Step 3 already done for image {image_row['image']}, skipped.")
-                with open(csv_output_path, 'a', newline='', encoding='utf-8-sig') as resumption_csv:
-                    resumption_writer = csv.DictWriter(resumption_csv, fieldnames=instructions_reader.fieldnames, dialect='excel', delimiter=';')
-                    resumption_writer.writerow(image_row)
-        try:
-            csv_output_path.replace(csv_input_path)
-        except PermissionError as pe:
-            logging.error(f"Error with permission when trying to rename the file: {pe}")
-    except FileNotFoundError as fnfe:
-        logging.error(f"CSV file {csv_input_path} could not be found. Error: {fnfe}")
-    except IOError as ioe:
-        logging.error(f"I/O error while trying to read CSV file {csv_input_path}. Error: {ioe}")
+                store.update(target, i, done=3)
+            else:
+                logging.info (f"Step 3 already done for image {image_row['image']}, skipped.")
     except Exception as e: 
-        logging.error (f"Unexpected error while trying to read CSV file: {e}")
+        logging.error (f"Unexpected error in step 3: {e}")
+
+def eval_rows(store, target):
 
     logging.info ("\nStep 4: Evaluating IoU and Accuracy between FastSAM and PerSAM masks.")
+    evaluated_scores = []
     try:
-        persam_mIoU, persam_mAcc, persam_f_mIoU, persam_f_mAcc  = 0, 0, 0, 0
-        count = 0
-        with open(csv_input_path, newline='', encoding='utf-8-sig') as instructions_csv:
-            instructions_reader = csv.DictReader(instructions_csv, dialect='excel', delimiter=';')
-            with open(csv_output_path, 'w', newline='', encoding='utf-8-sig') as resumption_csv:
-                resumption_writer = csv.DictWriter(resumption_csv, fieldnames=instructions_reader.fieldnames, dialect='excel', delimiter=';')
-                resumption_writer.writeheader()
-            for image_row in instructions_reader:
-                if int(image_row['done']) <= 3:
-                    persam_IoU, persam_Acc, persam_f_IoU, persam_f_Acc = eval_mIoU(target, image_row)
-                    image_row['done'] = 4
-                    image_row['persam_IoU'] = str(round(persam_IoU, 2))
-                    image_row['persam_Acc'] = str(round(persam_Acc, 2))
-                    image_row['persam_f_IoU'] = str(round(persam_f_IoU, 2))
-                    image_row['persam_f_Acc'] = str(round(persam_f_Acc, 2))
-                    persam_mIoU += persam_IoU
-                    persam_mAcc += persam_Acc
-                    persam_f_mIoU += persam_f_IoU
-                    persam_f_mAcc += persam_f_Acc
-                    count +=1
-                else:
-                    logging.info (f"Step 4 already done for image {image_row['image']}, skipped.")
-                with open(csv_output_path, 'a', newline='', encoding='utf-8-sig') as resumption_csv:
-                    resumption_writer = csv.DictWriter(resumption_csv, fieldnames=instructions_reader.fieldnames, dialect='excel', delimiter=';')
-                    resumption_writer.writerow(image_row)
-        try:
-            csv_output_path.replace(csv_input_path)
-        except PermissionError as pe:
-            logging.error(f"Error with permission when trying to rename the file: {pe}")
-    except FileNotFoundError as fnfe:
-        logging.error(f"CSV file {csv_input_path} could not be found. Error: {fnfe}")
-    except IOError as ioe:
-        logging.error(f"I/O error while trying to read CSV file {csv_input_path}. Error: {ioe}")
+        image_rows = store.rows(target)
+        pending_rows = [i for i, image_row in enumerate(image_rows) if int(image_row['done']) <= 3]
+        row_scores = dict(zip(pending_rows, eval_mIoU_rows(target, [image_rows[i] for i in pending_rows])))
+        for i, image_row in enumerate(image_rows):
+            if i in pending_rows and row_scores[i] is not None:
+                save_scores(store, target, i, row_scores[i])
+                evaluated_scores.append(row_scores[i])
+            elif i in pending_rows:
+                logging.warning (f"Step 4 failed for image {image_row['image']}, it stays pending.")
+            else:
+                logging.info (f"Step 4 already done for image {image_row['image']}, skipped.")
     except Exception as e: 
-        logging.error (f"Unexpected error while trying to read CSV file: {e}")
+        logging.error (f"Unexpected error in step 4: {e}")
+
+    write_overall_eval(target, evaluated_scores)
+
+def segment_rows_pipelined(store, target):
+    # Every row goes through the steps on its own, each step has its own worker. PerSAM starts as soon
+    # as the FastSAM mask of a row exists. The evaluation of a row also compares against the FastSAM
+    # masks of all other rows, so it waits until step 1 is finished for the whole CSV.
 
+    logging.info (f"\nSteps 1 to 4 pipelined for target {target}")
+    image_rows = store.rows(target)
+    step_functions = {1: fastSAM, 2: perSAM_step, 3: perSAM_F_step}
+    executors = {step: ThreadPoolExecutor(max_workers=1) for step in step_functions}
+    if args.evaluation_workers > 1:
+        executors[4] = ProcessPoolExecutor(max_workers=args.evaluation_workers)
+    else:
+        executors[4] = ThreadPoolExecutor(max_workers=1)
+    running = {}
+    waiting_for_eval = []
+    row_scores = {}
+
+    def submit(i):
+        image_row = image_rows[i]
+        step = done_step(image_row) + 1
+        if step <= 3:
+            future = executors[step].submit(step_functions[step], target, image_row)
+        else:
+            future = executors[4].submit(eval_mIoU_MIMUL.evaluate_input, args.input_output_directory, args.manufacturer, target, image_row['mode'], image_row['image'].strip('.jpg'))
+        running[future] = (step, i)
+
+    try:
+        for i, image_row in enumerate(image_rows):
+            if done_step(image_row) == 3:
+                waiting_for_eval.append(i)
+            elif done_step(image_row) < 3:
+                submit(i)
+            else:
+                logging.info (f"All steps already done for image {image_row['image']}, skipped.")
+
+        while running or waiting_for_eval:
+            if not any(step == 1 for step, i in running.values()):
+                for i in waiting_for_eval:
+                    submit(i)
+                waiting_for_eval = []
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step, i = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.error (f"Unexpected error in step {step} for image {image_rows[i]['image']}, it stays pending. Error: {e}")
+                    continue
+                if step == 1 and getattr(result, 'returncode', -1) != 0:
+                    logging.warning (f"Step 1 failed for image {image_rows[i]['image']}, it stays pending.")
+                elif step < 3:
+                    image_rows[i] = store.update(target, i, done=step)
+                    submit(i)
+                elif step == 3:
+                    image_rows[i] = store.update(target, i, done=step)
+                    waiting_for_eval.append(i)
+                else:
+                    image_rows[i] = save_scores(store, target, i, result)
+                    row_scores[i] = result
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+
+    write_overall_eval(target, [row_scores[i] for i in sorted(row_scores)])
+
+def done_step(image_row):
+    return 0 if image_row['done'] == '' or image_row['done'] == None else int(image_row['done'])
+
+def save_scores(store, target, i, scores):
+    return store.update(target, i,
+                        done=4,
+                        persam_IoU=round(scores['persam']['mIoU'], 2),
+                        persam_Acc=round(scores['persam']['mAcc'], 2),
+                        persam_f_IoU=round(scores['persam_f']['mIoU'], 2),
+                        persam_f_Acc=round(scores['persam_f']['mAcc'], 2))
+
+def write_overall_eval(target, evaluated_scores):
+    # evaluated_scores in the order of the CSV, so the sums do not depend on how the rows were evaluated
+    count = len(evaluated_scores)
     if count > 0:
 
-        persam_mIoU = str(round(persam_mIoU / count, 2))
-        persam_mAcc = str(round(persam_mAcc / count, 2))
+        persam_mIoU = str(round(sum(scores['persam']['mIoU'] for scores in evaluated_scores) / count, 2))
+        persam_mAcc = str(round(sum(scores['persam']['mAcc'] for scores in evaluated_scores) / count, 2))
 
-        persam_f_mIoU = str(round(persam_f_mIoU / count, 2))
-        persam_f_mAcc = str(round(persam_f_mAcc / count, 2))
+        persam_f_mIoU = str(round(sum(scores['persam_f']['mIoU'] for scores in evaluated_scores) / count, 2))
+        persam_f_mAcc = str(round(sum(scores['persam_f']['mAcc'] for scores in evaluated_scores) / count, 2))
 
         logging.info(f"\nOverall PerSAM_mIoU for target {target}: {persam_mIoU}")
         logging.info(f"Overall PerSAM_mAcc for target {target}: {persam_mAcc}")
@@ -232,12 +428,21 @@ def csv_segmentation(csv_input_path, csv_output_path, target):
         logging.info(f"\nOverall PerSAM_F_mIoU for target {target}: {persam_f_mIoU}")
         logging.info(f"Overall PerSAM_F_mAcc for target {target}: {persam_f_mAcc}")
 
+        # IoU and Acc over the pixels of all evaluated rows together
+        pooled = {}
+        for method in ('persam', 'persam_f'):
+            intersection = sum(scores[method]['intersection'] for scores in evaluated_scores)
+            union = sum(scores[method]['union'] for scores in evaluated_scores)
+            target_area = sum(scores[method]['target'] for scores in evaluated_scores)
+            pooled[f'{method}_pooled_IoU'] = str(round(100 * intersection / (union + 1e-10), 2))
+            pooled[f'{method}_pooled_Acc'] = str(round(100 * intersection / (target_area + 1e-10), 2))
+
         overall_eval_path = f'{args.input_output_directory}/{args.manufacturer}/Outputs/{target}/overall_eval.csv'
         with open(overall_eval_path, 'w', newline='', encoding='utf-8-sig') as eval_csv:
-            fieldnames = ['target', 'persam_mIoU', 'persam_mAcc', 'persam_f_mIoU', 'persam_f_mAcc']
+            fieldnames = ['target', 'persam_mIoU', 'persam_mAcc', 'persam_f_mIoU', 'persam_f_mAcc'] + list(pooled)
             eval_writer = csv.DictWriter(eval_csv, fieldnames=fieldnames, dialect='excel', delimiter=';')
             eval_writer.writeheader()
-            eval_writer.writerow({'target': target, 'persam_mIoU': persam_mIoU, 'persam_mAcc': persam_mAcc, 'persam_f_mIoU': persam_f_mIoU, 'persam_f_mAcc': persam_f_mAcc})
+            eval_writer.writerow({'target': target, 'persam_mIoU': persam_mIoU, 'persam_mAcc': persam_mAcc, 'persam_f_mIoU': persam_f_mIoU, 'persam_f_mAcc': persam_f_mAcc, **pooled})
 
 def fastSAM(target, image_row):
 
@@ -249,18 +454,29 @@ def fastSAM(target, image_row):
 
     logging.info (f"Segmenting {target} from {id} of manufacturer {args.manufacturer} using {mode} mode.")
 
+    mode_argv = []
+
     if (mode == 'box'):
         box = image_row['box']
         mode_details = f"-b \"{box}\""
+        mode_argv = ['-b', box]
         logging.info (f"Box input is {box}. Added mode details: \"{mode_details}\"")
     elif (mode == 'points'):
         points = image_row['points']
         point_labels = image_row['point_labels']
         mode_details = f"-p \"{points}\" -pl \"{point_labels}\""
+        mode_argv = ['-p', points, '-pl', point_labels]
         logging.info (f"Points input is \"{points}\" point labels are \"{point_labels}\". Added mode details: \"{mode_details}\"")
     else:
         logging.warning (f"Mode {mode} not supported. Please check spelling and choose either \"box\" or \"points\".")
 
+    if args.prompted_inference:
+        mode_details += " -pi"
+        mode_argv.append('-pi')
+
+    if args.in_process:
+        return fastSAM_in_process(target, id, mode, mode_argv)
+
     logging.info (f"Calling python \".\FastSAM_MIMUL.py\" -d {args.device} -io \"{args.input_output_directory}\" -ma \"{args.manufacturer}\" -t {target} -i {id} -m {mode} {mode_details}")
     try:
         return subprocess.run(f"python \".\FastSAM_MIMUL.py\" -d {args.device} -io \"{args.input_output_directory}\" -ma \"{args.manufacturer}\" -t {target} -i {id} -m {mode} {mode_details}")
@@ -271,15 +487,42 @@ def fastSAM(target, image_row):
         logging.error (f"Unexpected error while trying to execute FastSAM subprocess with input {id} and FastSAM mask generated in {mode} mode for target {target}. Error: {e}")
         return -1
 
+def fastSAM_in_process(target, id, mode, mode_argv):
+    import FastSAM_MIMUL
+
+    step_argv = step_arguments(target, id, mode) + mode_argv
+    logging.info (f"Calling FastSAM_MIMUL.main in process with arguments {step_argv}")
+    try:
+        step_args = FastSAM_MIMUL.parse_args(step_argv)
+        FastSAM_MIMUL.main(step_args, get_fastsam_model())
+        return subprocess.CompletedProcess(step_argv, 0)
+    except SystemExit as se:
+        logging.error(f"Invalid arguments for FastSAM with input {id} in {mode} mode for target {target}. Exit code: {se.code}")
+        return subprocess.CompletedProcess(step_argv, 2)
+    except Exception as e:
+        logging.error(f"Unforseen error occured at FastSAM (step 1) with input {id} in {mode} mode for target {target}. Error: {e}")
+        return subprocess.CompletedProcess(step_argv, 1)
+
 def perSAM(target, image_row):
     id = image_row['image'].strip('.jpg')
     mode = image_row['mode']
 
     logging.info (f"\nTesting with input {id} and FastSAM mask generated in {mode} mode for target {target}.")
 
-    logging.info (f"Calling python \".\PerSAM_MIMUL.py\" -d \"{args.device}\" -io \"{args.input_output_directory}\" -ma \"{args.manufacturer}\" -t {target} -i {id} -m {mode}")
+    if args.in_process:
+        import PerSAM_MIMUL
+
+        step_argv = reference_arguments(target, image_row)
+        logging.info (f"Calling PerSAM_MIMUL.main in process with arguments {step_argv}")
+        try:
+            PerSAM_MIMUL.main(PerSAM_MIMUL.parse_args(step_argv), *get_sam_predictors())
+        except Exception as e:
+            logging.error (f"Unexpected error while running PerSAM in process with input {id} and FastSAM mask generated in {mode} mode for target {target}. Error: {e}")
+        return
+
+    logging.info (f"Calling python \".\PerSAM_MIMUL.py\" -d \"{args.device}\" -io \"{args.input_output_directory}\" -ma \"{args.manufacturer}\" -t {target} -i {id} -m {mode}{sam_step_options()}")
     try:
-        subprocess.run(f"python \".\perSAM_MIMUL.py\" -d \"{args.device}\" -io \"{args.input_output_directory}\" -ma \"{args.manufacturer}\" -t {target} -i {id} -m {mode}")
+        subprocess.run(f"python \".\perSAM_MIMUL.py\" -d \"{args.device}\" -io \"{args.input_output_directory}\" -ma \"{args.manufacturer}\" -t {target} -i {id} -m {mode}{sam_step_options()}")
     except subprocess.CalledProcessError as cpe:
         logging.error(f"Error while excecuting PerSAM subprocess with input {id} and FastSAM mask generated in {mode} mode for target {target}. Error: {cpe}")
     except Exception as e: 
@@ -292,29 +535,134 @@ def perSAM_F(target, image_row):
 
     logging.info (f"\nTesting with input {id} and FastSAM mask generated in {mode} mode for target {target}.")
 
-    logging.info (f"\nCalling python \".\PerSAM_F_MIMUL.py\" -d \"{args.device}\" -io \"{args.input_output_directory}\" -ma \"{args.manufacturer}\" -t {target} -i {id} -m {mode}")
+    if args.in_process:
+        import PerSAM_F_MIMUL
+
+        step_argv = reference_arguments(target, image_row)
+        logging.info (f"Calling PerSAM_F_MIMUL.main in process with arguments {step_argv}")
+        try:
+            PerSAM_F_MIMUL.main(PerSAM_F_MIMUL.parse_args(step_argv), *get_sam_predictors())
+        except Exception as e:
+            logging.error (f"Unexpected error while running PerSAM_F in process with input {id} and FastSAM mask generated in {mode} mode for target {target}. Error: {e}")
+        return
+
+    logging.info (f"\nCalling python \".\PerSAM_F_MIMUL.py\" -d \"{args.device}\" -io \"{args.input_output_directory}\" -ma \"{args.manufacturer}\" -t {target} -i {id} -m {mode}{sam_step_options()}")
     try:
-        subprocess.run(f"python \".\PerSAM_F_MIMUL.py\" -d \"{args.device}\" -io \"{args.input_output_directory}\" -ma \"{args.manufacturer}\" -t {target} -i {id} -m {mode}")
+        subprocess.run(f"python \".\PerSAM_F_MIMUL.py\" -d \"{args.device}\" -io \"{args.input_output_directory}\" -ma \"{args.manufacturer}\" -t {target} -i {id} -m {mode}{sam_step_options()}")
     except subprocess.CalledProcessError as cpe:
         logging.error(f"Error while excecuting PerSAM subprocess with input {id} and FastSAM mask generated in {mode} mode for target {target}. Error: {cpe}")
     except Exception as e: 
         logging.error (f"Unexpected error while trying to execute PerSAM subprocess with input {id} and FastSAM mask generated in {mode} mode for target {target}. Error: {e}")
 
 
+def perSAM_step(target, image_row):
+    # PerSAM and PerSAM_F share one predictor when they run in this process
+    with sam_lock if args.in_process else nullcontext():
+        perSAM(target, image_row)
+
+def perSAM_F_step(target, image_row):
+    with sam_lock if args.in_process else nullcontext():
+        perSAM_F(target, image_row)
+
+def perSAM_references(target, image_rows):
+    import PerSAM_MIMUL
+
+    references = [PerSAM_MIMUL.parse_args(reference_arguments(target, image_row)) for image_row in image_rows]
+    logging.info (f"\nTesting with {len(references)} reference inputs at once for target {target}: {[reference.input for reference in references]}")
+    try:
+        PerSAM_MIMUL.main_references(references, *get_sam_predictors())
+    except Exception as e:
+        logging.error (f"Unexpected error while running PerSAM for all reference inputs of target {target}. Error: {e}")
+
+def perSAM_F_references(target, image_rows):
+    import PerSAM_F_MIMUL
+
+    references = [PerSAM_F_MIMUL.parse_args(reference_arguments(target, image_row)) for image_row in image_rows]
+    logging.info (f"\nTesting with {len(references)} reference inputs at once for target {target}: {[reference.input for reference in references]}")
+    try:
+        PerSAM_F_MIMUL.main_references(references, *get_sam_predictors())
+    except Exception as e:
+        logging.error (f"Unexpected error while running PerSAM_F for all reference inputs of target {target}. Error: {e}")
+
+def reference_arguments(target, image_row):
+    return step_arguments(target, image_row['image'].strip('.jpg'), image_row['mode']) + sam_step_arguments()
+
+def step_arguments(target, id, mode):
+    return ['-d', args.device, '-io', args.input_output_directory, '-ma', args.manufacturer, '-t', target, '-i', id, '-m', mode]
+
+def sam_step_arguments():
+    sam_argv = ['-w', args.weights_directory, '-c', args.ckpt, '-eb', str(args.encoder_batch_size), '-vi', args.verification_images, '-lt', str(args.loader_threads), '-rd', args.reduced_decode, '-im', args.inference_mode]
+    if args.model_type:
+        sam_argv += ['-mt', args.model_type]
+    if args.embedding_cache:
+        sam_argv += ['-ec', args.embedding_cache]
+    if args.cascade_ckpt:
+        sam_argv += ['-cc', args.cascade_ckpt, '-cs', str(args.cascade_score), '-cp', str(args.cascade_peak)]
+    return sam_argv
+
+def sam_step_options():
+    return "".join(f" {arg}" if arg.startswith('-') else f" \"{arg}\"" for arg in sam_step_arguments())
+
+def get_fastsam_model():
+    global fastsam_model
+    if fastsam_model is None:
+        import FastSAM_MIMUL
+        logging.info ("Loading FastSAM once for all CSV rows.")
+        fastsam_model = FastSAM_MIMUL.load_model()
+    return fastsam_model
+
+def load_sam_predictors():
+    # The SAM predictor of --ckpt and, in cascade mode, the one of the screening model
+    from persam_common import load_predictor
+    predictor = load_predictor(args)
+    screening_predictor = None
+    if args.cascade_ckpt:
+        logging.info (f"Loading screening checkpoint {args.cascade_ckpt}.")
+        screening_predictor = load_predictor(args, args.cascade_ckpt)
+    return predictor, screening_predictor
+
+def get_sam_predictors():
+    global sam_predictors
+    if sam_predictors is None:
+        logging.info (f"Loading SAM checkpoint {args.ckpt} once for all CSV rows.")
+        sam_predictors = load_sam_predictors()
+    return sam_predictors
+
 def eval_mIoU(target, image_row):
     id = image_row['image'].strip('.jpg')
     mode = image_row['mode']
 
     logging.info (f"Evaluating PerSAM and PerSAM_F results for ID {id} with FastSAM mask generated in {mode} mode for target {target}.")
 
-    logging.info (f"\npersam_IoU, persam_Acc, persam_f_IoU, persam_f_Acc = eval_mIoU_MIMUL.eval_mIoU({args.input_output_directory}, {args.manufacturer}, {target}, {mode}, {id})")
+    logging.info (f"\nscores = eval_mIoU_MIMUL.evaluate_input({args.input_output_directory}, {args.manufacturer}, {target}, {mode}, {id})")
     try:
-        persam_IoU, persam_Acc, persam_f_IoU, persam_f_Acc = eval_mIoU_MIMUL.eval_mIoU(args.input_output_directory, args.manufacturer, target, mode, id)
+        scores = eval_mIoU_MIMUL.evaluate_input(args.input_output_directory, args.manufacturer, target, mode, id)
     except Exception as e: 
         logging.error (f"Unexpected error while trying to execute evaluation module with input {id} and FastSAM mask generated in {mode} mode for target {target}. Error: {e}")
-
-
-    return(persam_IoU, persam_Acc, persam_f_IoU, persam_f_Acc)
+        scores = None
+
+    return scores
+
+def eval_mIoU_rows(target, image_rows):
+    # Scores of every row in the order of image_rows, None for rows that failed
+    if args.evaluation_workers <= 1 or len(image_rows) <= 1:
+        return [eval_mIoU(target, image_row) for image_row in image_rows]
+
+    logging.info (f"Evaluating {len(image_rows)} rows with {args.evaluation_workers} worker processes.")
+    with ProcessPoolExecutor(max_workers=args.evaluation_workers) as executor:
+        futures = []
+        for image_row in image_rows:
+            id = image_row['image'].strip('.jpg')
+            mode = image_row['mode']
+            futures.append(executor.submit(eval_mIoU_MIMUL.evaluate_input, args.input_output_directory, args.manufacturer, target, mode, id))
+        row_scores = []
+        for image_row, future in zip(image_rows, futures):
+            try:
+                row_scores.append(future.result())
+            except Exception as e:
+                logging.error (f"Unexpected error while evaluating image {image_row['image']} with mode {image_row['mode']} for target {target}. Error: {e}")
+                row_scores.append(None)
+    return row_scores
 
 if __name__ == "__main__":
     try:
@@ -4,17 +4,17 @@ import torch.nn as nn
 from torch.nn import functional as F
 
 import os
-import cv2
-from tqdm import tqdm
 import argparse
-import matplotlib.pyplot as plt
 import warnings
 warnings.filterwarnings('ignore')
 
-from show import *
-from per_segment_anything import sam_model_registry, SamPredictor
+from mask_io import read_mask_png
+from image_loader import read_input_image, read_input_mask
+from location_prior import select_points
+from persam_common import load_tiers, load_tier_targets, segment_test_images
+from per_segment_anything import INFERENCE_MODES
 
-def parse_args():
+def parse_args(argv=None):
     
     parser = argparse.ArgumentParser()
 
@@ -26,21 +26,35 @@ def parse_args():
     parser.add_argument('-i', '--input', type=str, required=True, help='The file name (ID) of the image and mask files (without extention) to be used as reference input. Image needs to be JPG, Mask needs to be PNG in their respective folders.')
     parser.add_argument('-m', '--mode', type=str, required=True, default='box', help='The mode that FastSAM used to create the mask. Needed to find the right folder.')
     parser.add_argument('-c', '--ckpt', type=str, default='sam_vit_h_4b8939.pth', help='Needed if another checkpoint shall be used.')
+    parser.add_argument('-mt', '--model_type', type=str, required=False, choices=['vit_h', 'vit_l', 'vit_b', 'vit_t'], help='The SAM model of the checkpoint. \'vit_t\' is MobileSAM (mobile_sam.pt), its image encoder is many times faster than vit_h. By default it is guessed from the checkpoint name.')
+    parser.add_argument('-ec', '--embedding_cache', type=str, required=False, help='Directory for cached SAM image embeddings. Every image is then only encoded once per checkpoint, across targets, steps and reruns.')
+    parser.add_argument('-eb', '--encoder_batch_size', type=int, required=False, default=1, help='Number of test images encoded in one pass of the SAM image encoder. Larger batches use the CPU or GPU better but need more memory.')
+    parser.add_argument('-vi', '--verification_images', type=str, required=False, default='on', choices=['on', 'off', 'deferred'], help='Images of every mask drawn over its test image, for checking the results. \'deferred\' draws them after all masks are found, \'off\' skips them.')
+    parser.add_argument('-lt', '--loader_threads', type=int, required=False, default=2, help='Number of background threads that decode and resize the next test images while the encoder works. 0 loads them in between the encoder passes.')
+    parser.add_argument('-rd', '--reduced_decode', type=str, required=False, default='on', choices=['on', 'off'], help='Decode large JPEGs at 1/2, 1/4 or 1/8 resolution, as long as they stay larger than the encoder input. Much faster for big scans. \'off\' always decodes the full resolution, the encoder input then differs slightly.')
+    parser.add_argument('-im', '--inference_mode', type=str, required=False, default='fp32', choices=INFERENCE_MODES, help='Precision of the SAM image encoder. \'int8\' quantizes its linear layers, \'bf16\' runs it in bfloat16 on CPUs that support it. Both are much faster on the CPU, \'int8\' only works with -d cpu.')
+    parser.add_argument('-cc', '--cascade_ckpt', type=str, required=False, help='Checkpoint of a fast screening model, e.g. \'mobile_sam.pt\'. Every test image is then segmented with it first and only the uncertain masks are found again with --ckpt. Tiers.csv in the output folder tells which model made each mask.')
+    parser.add_argument('-cs', '--cascade_score', type=float, required=False, default=0.9, help='A mask of the screening model is uncertain if the IoU the SAM decoder predicts for it is lower.')
+    parser.add_argument('-cp', '--cascade_peak', type=float, required=False, default=4.0, help='A mask of the screening model is also uncertain if the peak of its similarity map stands out less, in standard deviations of the map.')
 
     parser.add_argument('--lr', type=float, default=1e-3) 
     parser.add_argument('--train_epoch', type=int, default=1000)
     parser.add_argument('--log_epoch', type=int, default=200)
+    parser.add_argument('--optimizer', type=str, default='adamw', choices=['adamw', 'lbfgs'], help='Optimizer for the mask weights. \'lbfgs\' usually converges in a few iterations, --train_epoch is then the maximum number of iterations.')
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.device == "CUDA" and args.inference_mode == 'int8':
+        parser.error("--inference_mode int8 only works on the CPU.")
     return args
 
 
-def main():
+def main(args, predictor=None, screening_predictor=None):
+    main_references([args], predictor, screening_predictor)
 
-    #path preparation
-    input_path = f'{args.input_output_directory}/{args.manufacturer}/Input/'
-    fastsam_input_path = f'{args.input_output_directory}/{args.manufacturer}/Outputs/{args.target}/FastSAM results'
-    output_path = f'{args.input_output_directory}/{args.manufacturer}/Outputs/{args.target}/PerSAM_F results/{args.mode}/input_{args.input}'
+def main_references(references, predictor=None, screening_predictor=None):
+    # All references share the model settings. They may come from several targets, the test
+    # images of a manufacturer are then encoded once for the references of all its targets.
+    args = references[0]
 
     chkpt = os.path.join(args.weights_directory + args.ckpt)
 
@@ -49,9 +63,33 @@ def main():
     else:
         print("Checkpoint not found.") 
         
-    persam_f(args, input_path, fastsam_input_path, output_path)
+    for manufacturer in dict.fromkeys(reference.manufacturer for reference in references):
+        group = [reference for reference in references if reference.manufacturer == manufacturer]
 
-def persam_f(args, input_path, fastsam_input_path, output_path):
+        #path preparation
+        input_path = f'{args.input_output_directory}/{manufacturer}/Input/'
+        fastsam_input_paths = [f'{reference.input_output_directory}/{manufacturer}/Outputs/{reference.target}/FastSAM results' for reference in group]
+        output_paths = [f'{reference.input_output_directory}/{manufacturer}/Outputs/{reference.target}/PerSAM_F results/{reference.mode}/input_{reference.input}' for reference in group]
+
+        persam_f_references(group, input_path, fastsam_input_paths, output_paths, predictor, screening_predictor)
+
+def persam_f(args, input_path, fastsam_input_path, output_path, predictor=None, screening_predictor=None):
+    persam_f_references([args], input_path, [fastsam_input_path], [output_path], predictor, screening_predictor)
+
+def persam_f_references(references, input_path, fastsam_input_paths, output_paths, predictor=None, screening_predictor=None):
+    # Every test image is encoded once and scored against the targets of all references in one matmul
+    args = references[0]
+
+    tiers, tier_ckpts = load_tiers(args, predictor, screening_predictor)
+    for tier_predictor in tiers:
+        for name, param in tier_predictor.model.named_parameters():
+            param.requires_grad = False
+    # The target features and mask weights differ between the models, every tier gets its own
+    tier_targets = load_tier_targets(references, tiers, load_reference, input_path, fastsam_input_paths)
+
+    segment_test_images(args, tiers, tier_targets, tier_ckpts, input_path, output_paths, predict_test_mask)
+
+def load_reference(args, predictor, input_path, fastsam_input_path):
     
     print(f"\n------------> Segmenting {args.target} from {args.manufacturer} input {args.input} with FastSAM mask in {args.mode}-prompt mode.")
     
@@ -59,41 +97,20 @@ def persam_f(args, input_path, fastsam_input_path, output_path):
     ref_image_path = f"{input_path}/{args.input}.jpg"
     ref_mask_path = f"{fastsam_input_path}/{args.mode}/Masks/{args.input}.png"
 
-    # Load images and masks
-    ref_image = cv2.imread(ref_image_path)
-    ref_image = cv2.cvtColor(ref_image, cv2.COLOR_BGR2RGB)
+    # Load image and mask straight at the encoder resolution, only the original size is kept
+    ref_image, original_size = read_input_image(ref_image_path, predictor.transform, args.reduced_decode == 'on')
+    ref_mask = read_input_mask(ref_mask_path, predictor.transform)
 
-    ref_mask = cv2.imread(ref_mask_path)
-    ref_mask = cv2.cvtColor(ref_mask, cv2.COLOR_BGR2RGB)
-
-    gt_mask = torch.tensor(ref_mask)[:, :, 0] > 0 
+    gt_mask = torch.tensor(read_mask_png(ref_mask_path))
     if args.device == "CUDA":
         gt_mask = gt_mask.float().unsqueeze(0).flatten(1).cuda()
     else:
         gt_mask = gt_mask.float().unsqueeze(0).flatten(1).cpu()
 
-    
-    print("======> Loading SAM" )
-    print(f'args.ckpt = {args.ckpt}')
-    if args.ckpt == 'sam_vit_h_4b8939.pth':
-        if args.device == "CUDA":
-            sam = sam_model_registry['vit_h'](checkpoint=f'weights/{args.ckpt}').cuda()
-        else:
-            sam = sam_model_registry['vit_h'](checkpoint=f'weights/{args.ckpt}').cpu()
-    elif args.ckpt == 'mobile_sam.pt':
-        sam_type, sam_ckpt = 'vit_t', 'weights/mobile_sam.pt'
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        sam = sam_model_registry[sam_type](checkpoint=sam_ckpt).to(device=device)
-        sam.eval()    
-    
-    for name, param in sam.named_parameters():
-        param.requires_grad = False
-    predictor = SamPredictor(sam)
-    
 
     print("======> Obtain Self Location Prior" )
     # Image features encoding
-    ref_mask = predictor.set_image(ref_image, ref_mask)
+    ref_mask = predictor.set_image(ref_image, ref_mask, original_size=original_size)
     ref_feat = predictor.features.squeeze().permute(1, 2, 0)
 
     ref_mask = F.interpolate(ref_mask, size=ref_feat.shape[0: 2], mode="bilinear")
@@ -112,45 +129,77 @@ def persam_f(args, input_path, fastsam_input_path, output_path):
     ref_feat = ref_feat.permute(2, 0, 1).reshape(C, h * w)
     sim = target_feat @ ref_feat
 
-    sim = sim.reshape(1, 1, h, w)
-    sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
-    sim = predictor.model.postprocess_masks(
-                    sim,
-                    input_size=predictor.input_size,
-                    original_size=predictor.original_size).squeeze()
-
-    # Positive location prior
-    topk_xy, topk_label = point_selection(sim, topk=1)
+    # Positive location prior, found on the low resolution map
+    sim = sim.reshape(h, w)
+    topk_xy, topk_label = point_selection(sim, predictor.input_size, predictor.original_size, predictor.model.image_encoder.img_size, topk=1)
 
 
     print('======> Start Training')
-    # Learnable mask weights
+    # The SAM parameters are frozen and the prompt does not change between epochs,
+    # so the decoder is run once and only the mask weights are trained on its logits.
+    masks, scores, logits, logits_high = predictor.predict(
+        point_coords=topk_xy,
+        point_labels=topk_label,
+        multimask_output=True)
+    logits_high = logits_high.flatten(1)
+
+    mask_weights = train_mask_weights(args, logits_high, gt_mask)
+
+    mask_weights.eval()
+    weights = torch.cat((1 - mask_weights.weights.sum(0).unsqueeze(0), mask_weights.weights), dim=0)
+    weights_np = weights.detach().cpu().numpy()
+    print('======> Mask weights:\n', weights_np)
+
+    return target_feat, weights
+
+def predict_test_mask(predictor, sim, weights):
+
+    # Positive location prior, found on the low resolution map
+    topk_xy, topk_label = point_selection(sim[0, 0], predictor.input_size, predictor.original_size, predictor.model.image_encoder.img_size, topk=1)
+
+    # First-step prediction with the weighted sum of the three-scale masks, then the
+    # cascaded post-refinement, all on the low resolution logits
+    final_mask, score, best_idx = predictor.predict_cascade(topk_xy, topk_label, mask_weights=weights)
+    return final_mask, score, best_idx, topk_xy, topk_label
 
+def train_mask_weights(args, logits_high, gt_mask):
+    # Learnable mask weights
     if args.device == "CUDA":
         mask_weights = Mask_Weights().cuda()
     else:
         mask_weights = Mask_Weights().cpu()
     mask_weights.train()
-    
+
+    def weighted_loss():
+        # Weighted sum three-scale masks
+        weights = torch.cat((1 - mask_weights.weights.sum(0).unsqueeze(0), mask_weights.weights), dim=0)
+        logit_high = (logits_high * weights).sum(0).unsqueeze(0)
+
+        dice_loss = calculate_dice_loss(logit_high, gt_mask)
+        focal_loss = calculate_sigmoid_focal_loss(logit_high, gt_mask)
+        return dice_loss, focal_loss
+
+    if args.optimizer == 'lbfgs':
+        optimizer = torch.optim.LBFGS(mask_weights.parameters(), lr=1, max_iter=args.train_epoch, line_search_fn='strong_wolfe')
+
+        def closure():
+            optimizer.zero_grad()
+            dice_loss, focal_loss = weighted_loss()
+            loss = dice_loss + focal_loss
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+        dice_loss, focal_loss = weighted_loss()
+        print('LBFGS iterations: {:}, Dice_Loss: {:.4f}, Focal_Loss: {:.4f}'.format(optimizer.state_dict()['state'][0]['n_iter'], dice_loss.item(), focal_loss.item()))
+        return mask_weights
+
     optimizer = torch.optim.AdamW(mask_weights.parameters(), lr=args.lr, eps=1e-4)
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, args.train_epoch)
 
     for train_idx in range(args.train_epoch):
 
-        # Run the decoder
-        masks, scores, logits, logits_high = predictor.predict(
-            point_coords=topk_xy,
-            point_labels=topk_label,
-            multimask_output=True)
-        logits_high = logits_high.flatten(1)
-
-        # Weighted sum three-scale masks
-        weights = torch.cat((1 - mask_weights.weights.sum(0).unsqueeze(0), mask_weights.weights), dim=0)
-        logits_high = logits_high * weights
-        logits_high = logits_high.sum(0).unsqueeze(0)
-
-        dice_loss = calculate_dice_loss(logits_high, gt_mask)
-        focal_loss = calculate_sigmoid_focal_loss(logits_high, gt_mask)
+        dice_loss, focal_loss = weighted_loss()
         loss = dice_loss + focal_loss
 
         optimizer.zero_grad()
@@ -163,112 +212,7 @@ def persam_f(args, input_path, fastsam_input_path, output_path):
             current_lr = scheduler.get_last_lr()[0]
             print('LR: {:.6f}, Dice_Loss: {:.4f}, Focal_Loss: {:.4f}'.format(current_lr, dice_loss.item(), focal_loss.item()))
 
-
-    mask_weights.eval()
-    weights = torch.cat((1 - mask_weights.weights.sum(0).unsqueeze(0), mask_weights.weights), dim=0)
-    weights_np = weights.detach().cpu().numpy()
-    print('======> Mask weights:\n', weights_np)
-
-    print('======> Start Testing')
-    # for test_idx in tqdm(range(len(os.listdir(args.image_input)))):
-    for test_image in tqdm(os.listdir(input_path)):
-
-        # Load test image
-        test_image_path = f"{input_path}/{test_image}"
-        if os.path.isfile(test_image_path):
-
-            test_image_name = test_image.strip('.jpg')
-            test_image = cv2.imread(test_image_path)
-            test_image = cv2.cvtColor(test_image, cv2.COLOR_BGR2RGB)
-
-            # Image feature encoding
-            predictor.set_image(test_image)
-            test_feat = predictor.features.squeeze()
-
-            # Cosine similarity
-            C, h, w = test_feat.shape
-            test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
-            test_feat = test_feat.reshape(C, h * w)
-            sim = target_feat @ test_feat
-
-            sim = sim.reshape(1, 1, h, w)
-            sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
-            sim = predictor.model.postprocess_masks(
-                            sim,
-                            input_size=predictor.input_size,
-                            original_size=predictor.original_size).squeeze()
-
-            # Positive location prior
-            topk_xy, topk_label = point_selection(sim, topk=1)
-
-            # First-step prediction
-            masks, scores, logits, logits_high = predictor.predict(
-                        point_coords=topk_xy,
-                        point_labels=topk_label,
-                        multimask_output=True)
-
-            # Weighted sum three-scale masks
-            logits_high = logits_high * weights.unsqueeze(-1)
-            logit_high = logits_high.sum(0)
-            mask = (logit_high > 0).detach().cpu().numpy()
-
-            logits = logits * weights_np[..., None]
-            logit = logits.sum(0)
-
-            # Cascaded Post-refinement-1
-            y, x = np.nonzero(mask)
-            x_min = x.min()
-            x_max = x.max()
-            y_min = y.min()
-            y_max = y.max()
-            input_box = np.array([x_min, y_min, x_max, y_max])
-            masks, scores, logits, _ = predictor.predict(
-                point_coords=topk_xy,
-                point_labels=topk_label,
-                box=input_box[None, :],
-                mask_input=logit[None, :, :],
-                multimask_output=True)
-            best_idx = np.argmax(scores)
-
-            # Cascaded Post-refinement-2
-            y, x = np.nonzero(masks[best_idx])
-            x_min = x.min()
-            x_max = x.max()
-            y_min = y.min()
-            y_max = y.max()
-            input_box = np.array([x_min, y_min, x_max, y_max])
-            masks, scores, logits, _ = predictor.predict(
-                point_coords=topk_xy,
-                point_labels=topk_label,
-                box=input_box[None, :],
-                mask_input=logits[best_idx: best_idx + 1, :, :],
-                multimask_output=True)
-            best_idx = np.argmax(scores)
-            
-            # Save masks
-            plt.figure(figsize=(10, 10))
-            plt.imshow(test_image)
-            show_mask(masks[best_idx], plt.gca())
-            show_points(topk_xy, topk_label, plt.gca())
-            plt.title(f"Mask {best_idx}", fontsize=18)
-            plt.axis('off')
-            vis_mask_output_folder = os.path.join(output_path, 'Images')
-            if not os.path.exists(vis_mask_output_folder):
-                os.makedirs(vis_mask_output_folder, exist_ok=True)
-            vis_mask_output_path = os.path.join(vis_mask_output_folder,  f'vis_mask_{test_image_name}.jpg')
-            with open(vis_mask_output_path, 'wb') as outfile:
-                plt.savefig(outfile, format='jpg')
-            final_mask = masks[best_idx]
-            mask_colors = np.zeros((final_mask.shape[0], final_mask.shape[1], 3), dtype=np.uint8)
-            mask_colors[final_mask, :] = np.array([[0, 0, 128]])
-            masks_output_folder = os.path.join(output_path, 'Masks')
-            if not os.path.exists(masks_output_folder):
-                os.makedirs(masks_output_folder, exist_ok=True)
-            mask_output_path = os.path.join(masks_output_folder,  f'{test_image_name}.png')
-            cv2.imwrite(mask_output_path, mask_colors)
-            plt.close(fig='all')
-        else:
-            print(f"{test_image_path} is not a file (probably a folder). Skipping.")
+    return mask_weights
 
 
 class Mask_Weights(nn.Module):
@@ -277,16 +221,10 @@ class Mask_Weights(nn.Module):
         self.weights = nn.Parameter(torch.ones(2, 1, requires_grad=True) / 3)
 
 
-def point_selection(mask_sim, topk=1):
-    # Top-1 point selection
-    w, h = mask_sim.shape
-    topk_xy = mask_sim.flatten(0).topk(topk)[1]
-    topk_x = (topk_xy // h).unsqueeze(0)
-    topk_y = (topk_xy - topk_x * h)
-    topk_xy = torch.cat((topk_y, topk_x), dim=0).permute(1, 0)
+def point_selection(sim, input_size, original_size, img_size, topk=1):
+    # Top-1 point selection on the similarity map of the embedding
+    topk_xy = select_points(sim, input_size, original_size, img_size, topk)
     topk_label = np.array([1] * topk)
-    topk_xy = topk_xy.cpu().numpy()
-    
     return topk_xy, topk_label
 
 
@@ -338,4 +276,4 @@ def calculate_sigmoid_focal_loss(inputs, targets, num_masks = 1, alpha: float =
 
 if __name__ == '__main__':
     args = parse_args()
-    main()
+    main(args)
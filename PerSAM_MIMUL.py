@@ -1,19 +1,17 @@
 import numpy as np
-import torch
 from torch.nn import functional as F
 
 import os
-import cv2
-from tqdm import tqdm
 import argparse
-import matplotlib.pyplot as plt
 import warnings
 warnings.filterwarnings('ignore')
 
-from show import *
-from per_segment_anything import sam_model_registry, SamPredictor
+from image_loader import read_input_image, read_input_mask
+from location_prior import select_points, target_guidance
+from persam_common import load_tiers, load_tier_targets, segment_test_images
+from per_segment_anything import INFERENCE_MODES
 
-def parse_args():
+def parse_args(argv=None):
     
     persam_parser = argparse.ArgumentParser()
 
@@ -25,16 +23,29 @@ def parse_args():
     persam_parser.add_argument('-i', '--input', type=str, required=True, help='The file name (ID) of the image and mask files (without extention) to be used as reference input. Image needs to be JPG, Mask needs to be PNG in their respective folders.')
     persam_parser.add_argument('-m', '--mode', type=str, required=True, default='box', help='The mode that FastSAM used to create the mask. Needed to find the right folder.')
     persam_parser.add_argument('-c', '--ckpt', type=str, required=False, default='sam_vit_h_4b8939.pth', help='Needed if another checkpoint shall be used.')
+    persam_parser.add_argument('-mt', '--model_type', type=str, required=False, choices=['vit_h', 'vit_l', 'vit_b', 'vit_t'], help='The SAM model of the checkpoint. \'vit_t\' is MobileSAM (mobile_sam.pt), its image encoder is many times faster than vit_h. By default it is guessed from the checkpoint name.')
+    persam_parser.add_argument('-ec', '--embedding_cache', type=str, required=False, help='Directory for cached SAM image embeddings. Every image is then only encoded once per checkpoint, across targets, steps and reruns.')
+    persam_parser.add_argument('-eb', '--encoder_batch_size', type=int, required=False, default=1, help='Number of test images encoded in one pass of the SAM image encoder. Larger batches use the CPU or GPU better but need more memory.')
+    persam_parser.add_argument('-vi', '--verification_images', type=str, required=False, default='on', choices=['on', 'off', 'deferred'], help='Images of every mask drawn over its test image, for checking the results. \'deferred\' draws them after all masks are found, \'off\' skips them.')
+    persam_parser.add_argument('-lt', '--loader_threads', type=int, required=False, default=2, help='Number of background threads that decode and resize the next test images while the encoder works. 0 loads them in between the encoder passes.')
+    persam_parser.add_argument('-rd', '--reduced_decode', type=str, required=False, default='on', choices=['on', 'off'], help='Decode large JPEGs at 1/2, 1/4 or 1/8 resolution, as long as they stay larger than the encoder input. Much faster for big scans. \'off\' always decodes the full resolution, the encoder input then differs slightly.')
+    persam_parser.add_argument('-im', '--inference_mode', type=str, required=False, default='fp32', choices=INFERENCE_MODES, help='Precision of the SAM image encoder. \'int8\' quantizes its linear layers, \'bf16\' runs it in bfloat16 on CPUs that support it. Both are much faster on the CPU, \'int8\' only works with -d cpu.')
+    persam_parser.add_argument('-cc', '--cascade_ckpt', type=str, required=False, help='Checkpoint of a fast screening model, e.g. \'mobile_sam.pt\'. Every test image is then segmented with it first and only the uncertain masks are found again with --ckpt. Tiers.csv in the output folder tells which model made each mask.')
+    persam_parser.add_argument('-cs', '--cascade_score', type=float, required=False, default=0.9, help='A mask of the screening model is uncertain if the IoU the SAM decoder predicts for it is lower.')
+    persam_parser.add_argument('-cp', '--cascade_peak', type=float, required=False, default=4.0, help='A mask of the screening model is also uncertain if the peak of its similarity map stands out less, in standard deviations of the map.')
     
-    args = persam_parser.parse_args()
+    args = persam_parser.parse_args(argv)
+    if args.device == "CUDA" and args.inference_mode == 'int8':
+        persam_parser.error("--inference_mode int8 only works on the CPU.")
     return args
 
-def main():
+def main(args, predictor=None, screening_predictor=None):
+    main_references([args], predictor, screening_predictor)
 
-    #path preparation
-    input_path = f'{args.input_output_directory}/{args.manufacturer}/Input'
-    fastsam_input_path = f'{args.input_output_directory}/{args.manufacturer}/Outputs/{args.target}/FastSAM results'
-    output_path = f'{args.input_output_directory}/{args.manufacturer}/Outputs/{args.target}/PerSAM results/{args.mode}/input_{args.input}'
+def main_references(references, predictor=None, screening_predictor=None):
+    # All references share the model settings. They may come from several targets, the test
+    # images of a manufacturer are then encoded once for the references of all its targets.
+    args = references[0]
 
     chkpt = os.path.join(args.weights_directory + args.ckpt)
 
@@ -43,43 +54,44 @@ def main():
     else:
         print("Checkpoint not found.")    
         
-    persam(input_path, fastsam_input_path, output_path)
+    for manufacturer in dict.fromkeys(reference.manufacturer for reference in references):
+        group = [reference for reference in references if reference.manufacturer == manufacturer]
 
-def persam(input_path, fastsam_input_path, output_path):
+        #path preparation
+        input_path = f'{args.input_output_directory}/{manufacturer}/Input'
+        fastsam_input_paths = [f'{reference.input_output_directory}/{manufacturer}/Outputs/{reference.target}/FastSAM results' for reference in group]
+        output_paths = [f'{reference.input_output_directory}/{manufacturer}/Outputs/{reference.target}/PerSAM results/{reference.mode}/input_{reference.input}' for reference in group]
+
+        persam_references(group, input_path, fastsam_input_paths, output_paths, predictor, screening_predictor)
+
+def persam(args, input_path, fastsam_input_path, output_path, predictor=None, screening_predictor=None):
+    persam_references([args], input_path, [fastsam_input_path], [output_path], predictor, screening_predictor)
+
+def persam_references(references, input_path, fastsam_input_paths, output_paths, predictor=None, screening_predictor=None):
+    # Every test image is encoded once and scored against the targets of all references in one matmul
+    args = references[0]
+
+    tiers, tier_ckpts = load_tiers(args, predictor, screening_predictor)
+    # The target features differ between the models, every tier gets its own
+    tier_targets = load_tier_targets(references, tiers, load_reference, input_path, fastsam_input_paths)
+
+    segment_test_images(args, tiers, tier_targets, tier_ckpts, input_path, output_paths, predict_test_mask)
+
+def load_reference(args, predictor, input_path, fastsam_input_path):
 
     print(f"\n------------> Segmenting {args.target} from {args.manufacturer} input {args.input} with FastSAM mask in {args.mode}-prompt mode.")
     
     # Path preparation
     ref_image_path = f"{input_path}/{args.input}.jpg"
     ref_mask_path = f"{fastsam_input_path}/{args.mode}/Masks/{args.input}.png"
-    os.makedirs(output_path, exist_ok=True)
-
-    # Load images and masks
-    ref_image = cv2.imread(ref_image_path)
-    ref_image = cv2.cvtColor(ref_image, cv2.COLOR_BGR2RGB)
-
-    ref_mask = cv2.imread(ref_mask_path)
-    ref_mask = cv2.cvtColor(ref_mask, cv2.COLOR_BGR2RGB)
-    
 
-    print(f"\n======> Loading SAM" )
-    if args.ckpt == 'sam_vit_h_4b8939.pth':
-        print(f"Using vit_h checkpoint: {args.ckpt}")
-        if args.device == "CUDA":
-            sam = sam_model_registry['vit_h'](checkpoint=f'weights/{args.ckpt}').cuda()
-        else:
-            sam = sam_model_registry['vit_h'](checkpoint=f'weights/{args.ckpt}').cpu()
-    elif args.ckpt == 'mobile_sam.pt':
-        print(f"Using vit_t checkpoint: {args.ckpt}")
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        sam = sam_model_registry['vit_t'](args.ckpt).to(device=device)
-        sam.eval()
-
-    predictor = SamPredictor(sam)
+    # Load image and mask straight at the encoder resolution, only the original size is kept
+    ref_image, original_size = read_input_image(ref_image_path, predictor.transform, args.reduced_decode == 'on')
+    ref_mask = read_input_mask(ref_mask_path, predictor.transform)
 
     print("======> Obtain Location Prior" )
     # Image features encoding
-    ref_mask = predictor.set_image(ref_image, ref_mask)
+    ref_mask = predictor.set_image(ref_image, ref_mask, original_size=original_size)
     ref_feat = predictor.features.squeeze().permute(1, 2, 0)
 
     ref_mask = F.interpolate(ref_mask, size=ref_feat.shape[0: 2], mode="bilinear")
@@ -91,124 +103,37 @@ def persam(input_path, fastsam_input_path, output_path):
     target_feat = target_embedding / target_embedding.norm(dim=-1, keepdim=True)
     target_embedding = target_embedding.unsqueeze(0)
 
+    return target_feat, target_embedding
 
-    print('======> Start Testing')
-    for test_image in tqdm(os.listdir(input_path)):
-
-        # Load test image
-        test_image_path = f"{input_path}/{test_image}"
-        if os.path.isfile(test_image_path):
-
-            test_image_name = test_image.strip('.jpg')
-            test_image = cv2.imread(test_image_path)
-            test_image = cv2.cvtColor(test_image, cv2.COLOR_BGR2RGB)
-
-            # Image feature encoding
-            predictor.set_image(test_image)
-            test_feat = predictor.features.squeeze()
-
-            # Cosine similarity
-            C, h, w = test_feat.shape
-            test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
-            test_feat = test_feat.reshape(C, h * w)
-            sim = target_feat @ test_feat
-
-            sim = sim.reshape(1, 1, h, w)
-            sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
-            sim = predictor.model.postprocess_masks(
-                            sim,
-                            input_size=predictor.input_size,
-                            original_size=predictor.original_size).squeeze()
-
-            # Positive-negative location prior
-            topk_xy_i, topk_label_i, last_xy_i, last_label_i = point_selection(sim, topk=1)
-            topk_xy = np.concatenate([topk_xy_i, last_xy_i], axis=0)
-            topk_label = np.concatenate([topk_label_i, last_label_i], axis=0)
-
-            # Obtain the target guidance for cross-attention layers
-            sim = (sim - sim.mean()) / torch.std(sim)
-            sim = F.interpolate(sim.unsqueeze(0).unsqueeze(0), size=(64, 64), mode="bilinear")
-            attn_sim = sim.sigmoid_().unsqueeze(0).flatten(3)
-
-            # First-step prediction
-            masks, scores, logits, _ = predictor.predict(
-                point_coords=topk_xy, 
-                point_labels=topk_label, 
-                multimask_output=False,
-                attn_sim=attn_sim,  # Target-guided Attention
-                target_embedding=target_embedding  # Target-semantic Prompting
-            )
-            best_idx = 0
-
-            # Cascaded Post-refinement-1
-            masks, scores, logits, _ = predictor.predict(
-                        point_coords=topk_xy,
-                        point_labels=topk_label,
-                        mask_input=logits[best_idx: best_idx + 1, :, :], 
-                        multimask_output=True)
-            best_idx = np.argmax(scores)
-
-            # Cascaded Post-refinement-2
-            y, x = np.nonzero(masks[best_idx])
-            x_min = x.min()
-            x_max = x.max()
-            y_min = y.min()
-            y_max = y.max()
-            input_box = np.array([x_min, y_min, x_max, y_max])
-            masks, scores, logits, _ = predictor.predict(
-                point_coords=topk_xy,
-                point_labels=topk_label,
-                box=input_box[None, :],
-                mask_input=logits[best_idx: best_idx + 1, :, :], 
-                multimask_output=True)
-            best_idx = np.argmax(scores)
-
-            # Save masks
-            plt.figure(figsize=(10, 10))
-            plt.imshow(test_image)
-            show_mask(masks[best_idx], plt.gca())
-            show_points(topk_xy, topk_label, plt.gca())
-            plt.title(f"Mask {best_idx}", fontsize=18)
-            plt.axis('off')
-            vis_mask_output_folder = os.path.join(output_path, 'Images')
-            if not os.path.exists(vis_mask_output_folder):
-                os.makedirs(vis_mask_output_folder, exist_ok=True)
-            vis_mask_output_path = os.path.join(vis_mask_output_folder,  f'vis_mask_{test_image_name}.jpg')
-            with open(vis_mask_output_path, 'wb') as outfile:
-                plt.savefig(outfile, format='jpg')
-            final_mask = masks[best_idx]
-            mask_colors = np.zeros((final_mask.shape[0], final_mask.shape[1], 3), dtype=np.uint8)
-            mask_colors[final_mask, :] = np.array([[0, 0, 128]])
-            masks_output_folder = os.path.join(output_path, 'Masks')
-            if not os.path.exists(masks_output_folder):
-                os.makedirs(masks_output_folder, exist_ok=True)
-            mask_output_path = os.path.join(masks_output_folder,  f'{test_image_name}.png')
-            cv2.imwrite(mask_output_path, mask_colors)
-            plt.close(fig='all')
-        else:
-            print(f"{test_image_path} is not a file (probably a folder). Skipping.")  
-            
-def point_selection(mask_sim, topk=1):
-    # Top-1 point selection
-    w, h = mask_sim.shape
-    topk_xy = mask_sim.flatten(0).topk(topk)[1]
-    topk_x = (topk_xy // h).unsqueeze(0)
-    topk_y = (topk_xy - topk_x * h)
-    topk_xy = torch.cat((topk_y, topk_x), dim=0).permute(1, 0)
+def predict_test_mask(predictor, sim, target_embedding):
+
+    # Positive-negative location prior, found on the low resolution map
+    img_size = predictor.model.image_encoder.img_size
+    topk_xy, topk_label, last_xy, last_label = point_selection(sim[0, 0], predictor.input_size, predictor.original_size, img_size, topk=1)
+    topk_xy = np.concatenate([topk_xy, last_xy], axis=0)
+    topk_label = np.concatenate([topk_label, last_label], axis=0)
+
+    # Obtain the target guidance for cross-attention layers
+    attn_sim = target_guidance(sim, predictor.input_size, img_size)
+
+    # First-step prediction and cascaded post-refinement, all on the low resolution logits
+    final_mask, score, best_idx = predictor.predict_cascade(
+        topk_xy,
+        topk_label,
+        attn_sim=attn_sim,  # Target-guided Attention
+        target_embedding=target_embedding  # Target-semantic Prompting
+    )
+    return final_mask, score, best_idx, topk_xy, topk_label
+
+def point_selection(sim, input_size, original_size, img_size, topk=1):
+    # Top-1 and top-last point selection on the similarity map of the embedding
+    topk_xy = select_points(sim, input_size, original_size, img_size, topk)
     topk_label = np.array([1] * topk)
-    topk_xy = topk_xy.cpu().numpy()
-        
-    # Top-last point selection
-    last_xy = mask_sim.flatten(0).topk(topk, largest=False)[1]
-    last_x = (last_xy // h).unsqueeze(0)
-    last_y = (last_xy - last_x * h)
-    last_xy = torch.cat((last_y, last_x), dim=0).permute(1, 0)
+    last_xy = select_points(sim, input_size, original_size, img_size, topk, largest=False)
     last_label = np.array([0] * topk)
-    last_xy = last_xy.cpu().numpy()
-    
     return topk_xy, topk_label, last_xy, last_label
-    
+
 
 if __name__ == "__main__":
     args = parse_args()
-    main()
+    main(args)
@@ -0,0 +1,104 @@
+import os
+import time
+import argparse
+
+import numpy as np
+
+import PerSAM_MIMUL
+from cascade import TIERS_FILE
+from eval_mIoU_MIMUL import pack_mask, intersectionAndUnionPacked
+from image_loader import read_input_image
+from mask_io import read_mask_png
+from persam_common import load_predictor
+
+# Compares SAM models for PerSAM on the rolls of a manufacturer, by default MobileSAM
+# (vit_t) against vit_h: the latency of the image encoder, the time of a whole PerSAM
+# run and the IoU of the masks with the FastSAM masks and with the masks of the first model.
+# With --cascade_ckpt the two-tier cascade of the screening model and the first model is
+# measured as well.
+
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description='Latency and IoU of SAM models in PerSAM.')
+
+    parser.add_argument('-d', '--device', type=str, required=False, default='cpu', help='The computing device to work on. To work on graphics card use \'CUDA\', default is \'cpu\'')
+    parser.add_argument('-w', '--weights_directory', type=str, required=False, default='./weights/')
+    parser.add_argument('-io', '--input_output_directory', type=str, required=True, help='Path to the working directory with inputs and outpus.')
+    parser.add_argument('-ma', '--manufacturer', type=str, required=True, help='The piano roll manufacturer.')
+    parser.add_argument('-t', '--target', type=str, required=True, help='The target that should be segmented.')
+    parser.add_argument('-i', '--input', type=str, required=True, help='The file name (ID) of the reference image and FastSAM mask (without extention).')
+    parser.add_argument('-m', '--mode', type=str, required=False, default='box', help='The mode that FastSAM used to create the mask.')
+    parser.add_argument('-c', '--ckpts', type=str, nargs='+', required=False, default=['sam_vit_h_4b8939.pth', 'mobile_sam.pt'], help='The checkpoints to compare. The first one is the reference for the IoU between the models.')
+    parser.add_argument('-im', '--inference_mode', type=str, required=False, default='fp32', choices=['fp32', 'int8', 'bf16'], help='Precision of the SAM image encoders.')
+    parser.add_argument('-cc', '--cascade_ckpt', type=str, required=False, help='Also run the cascade with this screening checkpoint, e.g. \'mobile_sam.pt\', and the first checkpoint.')
+    parser.add_argument('-cs', '--cascade_score', type=float, required=False, default=0.9, help='IoU prediction below which the cascade uses the first checkpoint.')
+    parser.add_argument('-cp', '--cascade_peak', type=float, required=False, default=4.0, help='Peak sharpness below which the cascade uses the first checkpoint.')
+    parser.add_argument('-n', '--number_of_images', type=int, required=False, default=5, help='Number of rolls the encoder latency is measured on.')
+
+    return parser.parse_args(argv)
+
+
+def mask_iou(mask, reference_mask):
+    intersection, union, _ = intersectionAndUnionPacked(pack_mask(mask), pack_mask(reference_mask))
+    return intersection / (union + 1e-10)
+
+
+def main(args):
+    base_path = f'{args.input_output_directory}/{args.manufacturer}'
+    input_path = f'{base_path}/Input'
+    fastsam_input_path = f'{base_path}/Outputs/{args.target}/FastSAM results'
+    fastsam_masks_path = f'{fastsam_input_path}/{args.mode}/Masks'
+    image_files = sorted(image_file for image_file in os.listdir(input_path) if os.path.isfile(f'{input_path}/{image_file}'))
+
+    results = []
+    for ckpt in args.ckpts:
+        persam_args = PerSAM_MIMUL.parse_args(['-d', args.device, '-w', args.weights_directory, '-io', args.input_output_directory, '-ma', args.manufacturer,
+                                               '-t', args.target, '-i', args.input, '-m', args.mode, '-c', ckpt, '-im', args.inference_mode, '-vi', 'off'])
+        predictor = load_predictor(persam_args)
+
+        # Latency of the image encoder alone, one roll per pass
+        encoder_seconds = []
+        for image_file in image_files[:args.number_of_images]:
+            input_image, original_size = read_input_image(f'{input_path}/{image_file}', predictor.transform)
+            start = time.perf_counter()
+            predictor.encode_batch([input_image], original_sizes=[original_size])
+            encoder_seconds.append(time.perf_counter() - start)
+
+        # A whole PerSAM run, masks go to a folder of their own
+        output_path = f'{base_path}/Outputs/{args.target}/Benchmark/{os.path.splitext(ckpt)[0]}/{args.mode}/input_{args.input}'
+        start = time.perf_counter()
+        PerSAM_MIMUL.persam(persam_args, input_path, fastsam_input_path, output_path, predictor)
+        persam_seconds = (time.perf_counter() - start) / len(image_files)
+        results.append((ckpt, np.mean(encoder_seconds), persam_seconds, f'{output_path}/Masks'))
+
+    if args.cascade_ckpt:
+        persam_args = PerSAM_MIMUL.parse_args(['-d', args.device, '-w', args.weights_directory, '-io', args.input_output_directory, '-ma', args.manufacturer, '-t', args.target, '-i', args.input, '-m', args.mode,
+                                               '-c', args.ckpts[0], '-im', args.inference_mode, '-vi', 'off', '-cc', args.cascade_ckpt, '-cs', str(args.cascade_score), '-cp', str(args.cascade_peak)])
+        predictor = load_predictor(persam_args)
+        screening_predictor = load_predictor(persam_args, args.cascade_ckpt)
+
+        output_path = f'{base_path}/Outputs/{args.target}/Benchmark/cascade/{args.mode}/input_{args.input}'
+        start = time.perf_counter()
+        PerSAM_MIMUL.persam(persam_args, input_path, fastsam_input_path, output_path, predictor, screening_predictor)
+        persam_seconds = (time.perf_counter() - start) / len(image_files)
+        results.append(('cascade', float('nan'), persam_seconds, f'{output_path}/Masks'))
+
+        with open(f'{output_path}/{TIERS_FILE}') as tiers_file:
+            tiers = [line.split(';')[1] for line in tiers_file.read().splitlines()[1:]]
+        print(f"\nCascade: {tiers.count('full')} of {len(tiers)} masks needed {args.ckpts[0]}.")
+
+    print(f"\n{'checkpoint':<28}{'encoder s':>11}{'PerSAM s':>10}{'IoU FastSAM':>13}{'IoU ' + args.ckpts[0][:12]:>18}")
+    for ckpt, encoder_seconds, persam_seconds, masks_path in results:
+        fastsam_ious, model_ious = [], []
+        for mask_file in sorted(os.listdir(masks_path)):
+            mask = read_mask_png(f'{masks_path}/{mask_file}')
+            if os.path.isfile(f'{fastsam_masks_path}/{mask_file}'):
+                fastsam_ious.append(mask_iou(mask, read_mask_png(f'{fastsam_masks_path}/{mask_file}')))
+            model_ious.append(mask_iou(mask, read_mask_png(f'{results[0][3]}/{mask_file}')))
+        fastsam_iou = np.mean(fastsam_ious) if fastsam_ious else float('nan')
+        print(f"{ckpt:<28}{encoder_seconds:>11.2f}{persam_seconds:>10.2f}{100 * fastsam_iou:>13.2f}{100 * np.mean(model_ious):>18.2f}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,36 @@
+import csv
+import os
+
+# Two-tier segmentation for PerSAM and PerSAM_F. A fast screening model (MobileSAM)
+# segments every test image first. Only the masks it is unsure about are found
+# again with the embedding of the model of --ckpt, so on easy rolls that model
+# hardly encodes anything. Tiers.csv in every output folder tells which tier
+# produced each mask.
+
+TIERS_FILE = 'Tiers.csv'
+TIER_NAMES = ['screening', 'full']
+
+
+def is_confident(score, sharpness, args):
+    """A screening mask is kept if the decoder trusts it and the location prior was found on a sharp peak."""
+    return score >= args.cascade_score and sharpness >= args.cascade_peak
+
+
+class TierLog(object):
+    """Writes one row per mask to Tiers.csv of each output path: the test image, the tier
+    and checkpoint that produced the mask, the IoU prediction of the decoder and the
+    peak sharpness of the similarity map.
+    """
+
+    def __init__(self, output_paths):
+        self.files = [open(os.path.join(output_path, TIERS_FILE), 'w', newline='') for output_path in output_paths]
+        self.writers = [csv.writer(tiers_file, dialect='excel', delimiter=';') for tiers_file in self.files]
+        for writer in self.writers:
+            writer.writerow(['image', 'tier', 'checkpoint', 'iou_prediction', 'peak_sharpness'])
+
+    def record(self, index, image, tier, checkpoint, score, sharpness):
+        self.writers[index].writerow([image, TIER_NAMES[tier], checkpoint, f'{score:.4f}', f'{sharpness:.2f}'])
+
+    def close(self):
+        for tiers_file in self.files:
+            tiers_file.close()
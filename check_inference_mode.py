@@ -0,0 +1,77 @@
+import os
+import time
+import argparse
+
+import torch
+from tqdm import tqdm
+
+from image_loader import read_input_image
+from per_segment_anything import sam_model_registry, SamPredictor, INFERENCE_MODES
+from per_segment_anything.utils.transforms import ResizeLongestSide
+
+# Compares the image embeddings of the faster CPU inference modes with the fp32
+# embeddings on the rolls of a manufacturer, before switching PerSAM to them.
+
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description='Accuracy and speed of the SAM inference modes compared to fp32.')
+
+    parser.add_argument('-w', '--weights_directory', type=str, required=False, default='./weights/')
+    parser.add_argument('-c', '--ckpt', type=str, required=False, default='sam_vit_h_4b8939.pth', help='Needed if another checkpoint shall be used.')
+    parser.add_argument('-mt', '--model_type', type=str, required=False, default='vit_h', choices=list(sam_model_registry.keys()), help='The SAM model type of the checkpoint.')
+    parser.add_argument('-io', '--input_output_directory', type=str, required=True, help='Path to the working directory with inputs and outpus.')
+    parser.add_argument('-ma', '--manufacturer', type=str, required=True, help='The piano roll manufacturer whose rolls are used.')
+    parser.add_argument('-im', '--inference_modes', type=str, nargs='+', required=False, default=['int8', 'bf16'], choices=INFERENCE_MODES, help='The inference modes compared with fp32.')
+    parser.add_argument('-n', '--number_of_images', type=int, required=False, default=10, help='Number of rolls to encode.')
+
+    return parser.parse_args(argv)
+
+
+def encode_images(model_type, checkpoint, inference_mode, input_images):
+    sam = sam_model_registry[model_type](checkpoint=checkpoint, inference_mode=inference_mode).cpu()
+    predictor = SamPredictor(sam)
+    embeddings, seconds = [], []
+    for input_image, original_size in tqdm(input_images, desc=inference_mode):
+        start = time.perf_counter()
+        embedding = predictor.encode_batch([input_image], original_sizes=[original_size])[0]
+        seconds.append(time.perf_counter() - start)
+        embeddings.append(embedding['features'].squeeze(0))
+    return sam.inference_mode, embeddings, seconds
+
+
+def compare(embeddings, reference_embeddings):
+    # Cosine similarity per embedding position and error relative to the fp32 values
+    cosine, relative_error = [], []
+    for embedding, reference in zip(embeddings, reference_embeddings):
+        cosine.append(torch.nn.functional.cosine_similarity(embedding, reference, dim=0).flatten())
+        relative_error.append(((embedding - reference).norm() / reference.norm()).item())
+    cosine = torch.cat(cosine)
+    return cosine.mean().item(), cosine.min().item(), max(relative_error)
+
+
+def main(args):
+    input_path = f'{args.input_output_directory}/{args.manufacturer}/Input'
+    checkpoint = os.path.join(args.weights_directory, args.ckpt)
+    image_files = sorted(image_file for image_file in os.listdir(input_path) if os.path.isfile(f'{input_path}/{image_file}'))[:args.number_of_images]
+    transform = ResizeLongestSide(1024)
+    input_images = [read_input_image(f'{input_path}/{image_file}', transform) for image_file in image_files]
+
+    print(f"======> Encoding {len(input_images)} rolls of {args.manufacturer} in fp32")
+    _, reference_embeddings, reference_seconds = encode_images(args.model_type, checkpoint, 'fp32', input_images)
+    results = [('fp32', sum(reference_seconds) / len(reference_seconds), 1.0, 1.0, 0.0)]
+
+    for inference_mode in args.inference_modes:
+        used_mode, embeddings, seconds = encode_images(args.model_type, checkpoint, inference_mode, input_images)
+        if used_mode != inference_mode:
+            print(f"{inference_mode} is not available on this machine, skipped.")
+            continue
+        results.append((inference_mode, sum(seconds) / len(seconds), *compare(embeddings, reference_embeddings)))
+
+    print(f"\n{'mode':<6}{'s/image':>10}{'speedup':>10}{'mean cos':>10}{'min cos':>10}{'max rel err':>13}")
+    for inference_mode, mean_seconds, mean_cosine, min_cosine, relative_error in results:
+        print(f"{inference_mode:<6}{mean_seconds:>10.2f}{results[0][1] / mean_seconds:>10.2f}{mean_cosine:>10.4f}{min_cosine:>10.4f}{relative_error:>13.4f}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
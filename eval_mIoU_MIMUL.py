@@ -1,146 +1,92 @@
 import os
-import cv2
 import numpy as np
 import csv
 
-def eval_mIoU(input_output_directory, manufacturer, target, mode, id):
-
-    #path preparation
-    fastsam_output_path = f'{input_output_directory}/{manufacturer}/Outputs/{target}/FastSAM results/{mode}'
-    persam_output_path = f'{input_output_directory}/{manufacturer}/Outputs/{target}/PerSAM results/{mode}/input_{id}'
-    persam_f_output_path = f'{input_output_directory}/{manufacturer}/Outputs/{target}/PerSAM_F results/{mode}/input_{id}'
-
-    images = os.listdir(f'{fastsam_output_path}/Masks')
-
-    # compare fastsam masks with persam masks for this input
-
-    intersection_meter = AverageMeter()
-    union_meter = AverageMeter()
-    target_meter = AverageMeter()
-
-    count = 0
-    persam_mIoU = 0
-    persam_mAcc = 0
-
-    for image in images:
-
-        print(f"\nFastSAM input: {id} compared masks: {image}")
-
-        count += 1
-
-        fastsam_mask = f'{fastsam_output_path}/Masks/{image}'
-        fastsam_mask = cv2.imread(fastsam_mask)
-        fastsam_mask = cv2.cvtColor(fastsam_mask, cv2.COLOR_BGR2GRAY) > 0
-        fastsam_mask = np.uint8(fastsam_mask)
-        
-        persam_mask = f'{persam_output_path}/Masks/{image}'
-        persam_mask = cv2.imread(persam_mask)
-        persam_mask = cv2.cvtColor(persam_mask, cv2.COLOR_BGR2GRAY) > 0
-        persam_mask = np.uint8(persam_mask)
+from mask_io import read_mask_png
 
-        intersection, union, target = intersectionAndUnion(persam_mask, fastsam_mask)    
-        intersection_meter.update(intersection), union_meter.update(union), target_meter.update(target)
+# Number of set bits of every byte value, for counting pixels in packed masks
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
 
-        #print values
-        persam_IoU = intersection / (union + 1e-10)
-        persam_Acc = intersection / (target + 1e-10)
-
-        print("PerSAM IoU: %.2f," %(100 * persam_IoU), "PerSAM Acc: %.2f\n" %(100 * persam_Acc))
-
-        csv_output_path = f"{persam_output_path}/Evaluation.csv"
-
-        if count == 1:
-            with open(csv_output_path, 'w', newline='', encoding='utf-8-sig') as eval_csv:
-                fieldnames = ['image', 'persam_IoU', 'persam_Acc']
-                eval_writer = csv.DictWriter(eval_csv, fieldnames=fieldnames, dialect='excel', delimiter=';')
-                eval_writer.writeheader()
-
-        with open(csv_output_path, 'a', newline='', encoding='utf-8-sig') as eval_csv:
-            fieldnames = ['image', 'persam_IoU', 'persam_Acc']
-            eval_writer = csv.DictWriter(eval_csv, fieldnames=fieldnames, dialect='excel', delimiter=';')
-            eval_writer.writerow({'image': image, 'persam_IoU': persam_IoU, 'persam_Acc': persam_Acc})
+def eval_mIoU(input_output_directory, manufacturer, target, mode, id):
 
-        #calculate m-Values by hand
-        persam_mIoU += persam_IoU
-        persam_mAcc += persam_Acc
+    scores = evaluate_input(input_output_directory, manufacturer, target, mode, id)
 
-    #save values
-    persam_mIoU_bh = 100 * persam_mIoU / count
-    persam_mAcc_bh = 100 * persam_mAcc / count
-    
-    # print("\nPerSAM mIoU by hand = %.2f" %(100 * persam_mIoU / count), "PerSAM mAcc by hand = %.2f\n" %(100 * persam_mAcc / count))
-    print("\nPerSAM mIoU by hand = %.2f" %persam_mIoU_bh, "PerSAM mAcc by hand = %.2f\n" %(persam_mAcc_bh))
+    return(scores['persam']['mIoU'], scores['persam']['mAcc'], scores['persam_f']['mIoU'], scores['persam_f']['mAcc'])
 
+def evaluate_input(input_output_directory, manufacturer, target, mode, id):
+    # Every FastSAM mask is decoded once and PerSAM and PerSAM_F are scored against it in the same pass
 
-    persam_mIoU_wm = intersection_meter.sum / (union_meter.sum + 1e-10)
-    persam_mAcc_wm = intersection_meter.sum / (target_meter.sum + 1e-10)
-
-    print("PerSAM mIoU with meters: %.2f," %(100 * persam_mIoU_wm), "PerSAM mAcc with meters: %.2f\n" %(100 * persam_mAcc_wm))
+    #path preparation
+    fastsam_output_path = f'{input_output_directory}/{manufacturer}/Outputs/{target}/FastSAM results/{mode}'
+    output_paths = {
+        'persam': f'{input_output_directory}/{manufacturer}/Outputs/{target}/PerSAM results/{mode}/input_{id}',
+        'persam_f': f'{input_output_directory}/{manufacturer}/Outputs/{target}/PerSAM_F results/{mode}/input_{id}',
+    }
+    names = {'persam': 'PerSAM', 'persam_f': 'PerSAM_F'}
 
-    intersection_meter.reset()
-    union_meter.reset()
-    target_meter.reset()
+    images = os.listdir(f'{fastsam_output_path}/Masks')
 
-    count = 0
-    persam_f_mIoU = 0
-    persam_f_mAcc = 0
+    meters = {method: (AverageMeter(), AverageMeter(), AverageMeter()) for method in output_paths}
+    rows = {method: [] for method in output_paths}
 
     for image in images:
 
-        # intersection summieren und dann per hand noch mal teilen und mit averagemeter-Werten vergleichen
-
         print(f"\nFastSAM input: {id} compared masks: {image}")
 
-        count += 1
+        fastsam_mask = read_mask_png(f'{fastsam_output_path}/Masks/{image}')
+        mask_shape = fastsam_mask.shape
+        fastsam_mask = pack_mask(fastsam_mask)
 
-        fastsam_mask = f'{fastsam_output_path}/Masks/{image}'
-        fastsam_mask = cv2.imread(fastsam_mask)
-        fastsam_mask = cv2.cvtColor(fastsam_mask, cv2.COLOR_BGR2GRAY) > 0
-        fastsam_mask = np.uint8(fastsam_mask)
+        for method, output_path in output_paths.items():
+            persam_mask = read_mask_png(f'{output_path}/Masks/{image}')
+            assert persam_mask.shape == mask_shape
+            persam_mask = pack_mask(persam_mask)
 
-        persam_f_mask = f'{persam_f_output_path}/Masks/{image}'
-        persam_f_mask = cv2.imread(persam_f_mask)
-        persam_f_mask = cv2.cvtColor(persam_f_mask, cv2.COLOR_BGR2GRAY) > 0
-        persam_f_mask = np.uint8(persam_f_mask)
+            intersection, union, target_area = intersectionAndUnionPacked(persam_mask, fastsam_mask)
+            intersection_meter, union_meter, target_meter = meters[method]
+            intersection_meter.update(intersection), union_meter.update(union), target_meter.update(target_area)
 
-        intersection, union, target = intersectionAndUnion(persam_f_mask, fastsam_mask)    
-        intersection_meter.update(intersection), union_meter.update(union), target_meter.update(target)
+            #print values
+            IoU = intersection / (union + 1e-10)
+            Acc = intersection / (target_area + 1e-10)
 
-        #print values
-        persam_f_IoU = intersection / (union + 1e-10)
-        persam_f_Acc = intersection / (target + 1e-10)
+            print(f"{names[method]} IoU: %.2f," %(100 * IoU), f"{names[method]} Acc: %.2f" %(100 * Acc))
 
-        print("PerSAM_F IoU: %.2f," %(100 * persam_f_IoU), "PerSAM_F Acc: %.2f\n" %(100 * persam_f_Acc))
+            rows[method].append({'image': image, f'{method}_IoU': IoU, f'{method}_Acc': Acc})
 
-        csv_output_path = f"{persam_f_output_path}/Evaluation.csv"
+    scores = {}
+    for method, output_path in output_paths.items():
 
-        if count == 1:
-            with open(csv_output_path, 'w', newline='', encoding='utf-8-sig') as eval_csv:
-                fieldnames = ['image', 'persam_f_IoU', 'persam_f_Acc']
-                eval_writer = csv.DictWriter(eval_csv, fieldnames=fieldnames, dialect='excel', delimiter=';')
-                eval_writer.writeheader()
-
-        with open(csv_output_path, 'a', newline='', encoding='utf-8-sig') as eval_csv:
-            fieldnames = ['image', 'persam_f_IoU', 'persam_f_Acc']
+        # One buffered write per CSV
+        with open(f"{output_path}/Evaluation.csv", 'w', newline='', encoding='utf-8-sig') as eval_csv:
+            fieldnames = ['image', f'{method}_IoU', f'{method}_Acc']
             eval_writer = csv.DictWriter(eval_csv, fieldnames=fieldnames, dialect='excel', delimiter=';')
-            eval_writer.writerow({'image': image, 'persam_f_IoU': persam_f_IoU, 'persam_f_Acc': persam_f_Acc})
+            eval_writer.writeheader()
+            eval_writer.writerows(rows[method])
 
         #calculate m-Values by hand
-        persam_f_mIoU += persam_f_IoU
-        persam_f_mAcc += persam_f_Acc
+        count = len(rows[method])
+        mIoU_bh = 100 * sum(row[f'{method}_IoU'] for row in rows[method]) / count
+        mAcc_bh = 100 * sum(row[f'{method}_Acc'] for row in rows[method]) / count
 
-    persam_f_mIoU_bh = 100 * persam_f_mIoU / count
-    persam_f_mAcc_bh = 100 * persam_f_mAcc / count
+        print(f"\n{names[method]} mIoU by hand = %.2f" %mIoU_bh, f"{names[method]} mAcc by hand = %.2f\n" %(mAcc_bh))
 
-    print("\nPerSAM_F mIoU by hand = %.2f" %(persam_f_mIoU_bh), "PerSAM_F mAcc by hand = %.2f\n" %(persam_f_mAcc_bh))
+        intersection_meter, union_meter, target_meter = meters[method]
+        mIoU_wm = intersection_meter.sum / (union_meter.sum + 1e-10)
+        mAcc_wm = intersection_meter.sum / (target_meter.sum + 1e-10)
 
-    #save values
-    persam_f_mIoU_wm = intersection_meter.sum / (union_meter.sum + 1e-10)
-    persam_f_mAcc_wm = intersection_meter.sum / (target_meter.sum + 1e-10)
+        print(f"{names[method]} mIoU with meters: %.2f," %(100 * mIoU_wm), f"{names[method]} mAcc with meters: %.2f\n" %(100 * mAcc_wm))
 
-    print("PerSAM_F mIoU with meters: %.2f," %(100 * persam_f_mIoU_wm), "PerSAM_F mAcc with meters: %.2f\n" %(100 * persam_f_mAcc_wm))
-    
-    return(persam_mIoU_bh, persam_mAcc_bh, persam_f_mIoU_bh, persam_f_mAcc_bh)
+        scores[method] = {
+            'mIoU': mIoU_bh,
+            'mAcc': mAcc_bh,
+            'intersection': intersection_meter.sum,
+            'union': union_meter.sum,
+            'target': target_meter.sum,
+            'count': count,
+        }
+
+    return scores
 
 
 class AverageMeter(object):
@@ -178,3 +124,20 @@ def intersectionAndUnion(output, target):
 
     return area_intersection, area_union, area_target
 
+
+def pack_mask(mask):
+    # 8 pixels per byte
+    return np.packbits(mask.reshape(-1))
+
+def popcount(packed):
+    return int(POPCOUNT_TABLE[packed].sum(dtype=np.int64))
+
+def intersectionAndUnionPacked(output, target):
+
+    assert output.shape == target.shape
+
+    area_intersection = popcount(np.bitwise_and(output, target))
+    area_union = popcount(np.bitwise_or(output, target))
+    area_target = popcount(target)
+
+    return area_intersection, area_union, area_target
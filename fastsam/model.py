@@ -22,7 +22,7 @@ from .predict import FastSAMPredictor
 class FastSAM(YOLO):
 
     @smart_inference_mode()
-    def predict(self, source=None, stream=False, **kwargs):
+    def predict(self, source=None, stream=False, bboxes=None, points=None, **kwargs):
         """
         Perform prediction using the YOLO model.
 
@@ -30,6 +30,9 @@ class FastSAM(YOLO):
             source (str | int | PIL | np.ndarray): The source of the image to make predictions on.
                           Accepts all source types accepted by the YOLO model.
             stream (bool): Whether to stream the predictions or not. Defaults to False.
+            bboxes (list, optional): Box prompts [[x1, y1, x2, y2], ...] in original image coordinates. If given,
+                          only the masks that can answer the prompt are upsampled to full resolution.
+            points (list, optional): Point prompts [[x, y], ...] in original image coordinates, used like bboxes.
             **kwargs : Additional keyword arguments passed to the predictor.
                        Check the 'configuration' section in the documentation for all available options.
 
@@ -46,6 +49,8 @@ class FastSAM(YOLO):
         assert overrides['mode'] in ['track', 'predict']
         overrides['save'] = kwargs.get('save', False)  # do not save by default if called in Python
         self.predictor = FastSAMPredictor(overrides=overrides)
+        if bboxes is not None or points is not None:
+            self.predictor.prompts = {'bboxes': bboxes, 'points': points}
         self.predictor.setup_model(model=self.model, verbose=False)
         try:
             return self.predictor(source, stream=stream)
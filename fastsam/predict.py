@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 
 from ultralytics.yolo.engine.results import Results
 from ultralytics.yolo.utils import DEFAULT_CFG, ops
@@ -10,6 +11,8 @@ class FastSAMPredictor(DetectionPredictor):
     def __init__(self, cfg=DEFAULT_CFG, overrides=None, _callbacks=None):
         super().__init__(cfg, overrides, _callbacks)
         self.args.task = 'segment'
+        # Optional box or point prompts in original image coordinates, see prompt_candidates
+        self.prompts = None
 
     def postprocess(self, preds, img, orig_imgs):
         """TODO: filter by classes."""
@@ -43,6 +46,9 @@ class FastSAMPredictor(DetectionPredictor):
             if not len(pred):  # save empty boxes
                 results.append(Results(orig_img=orig_img, path=img_path, names=self.model.names, boxes=pred[:, :6]))
                 continue
+            if self.prompts is not None:
+                # Only the candidates for the prompt are upsampled to full resolution
+                pred = pred[self.prompt_candidates(proto[i], pred, img.shape[2:], orig_img.shape[:2])]
             if self.args.retina_masks:
                 if not isinstance(orig_imgs, torch.Tensor):
                     pred[:, :4] = ops.scale_boxes(img.shape[2:], pred[:, :4], orig_img.shape)
@@ -54,3 +60,58 @@ class FastSAMPredictor(DetectionPredictor):
             results.append(
                 Results(orig_img=orig_img, path=img_path, names=self.model.names, boxes=pred[:, :6], masks=masks))
         return results
+
+    def prompt_candidates(self, proto, pred, img_shape, orig_shape, topk=3):
+        """Select the detections that can answer the prompt, using the low resolution prototype masks.
+
+        Args:
+            proto (torch.Tensor): [mask_dim, mask_h, mask_w] prototypes of one image.
+            pred (torch.Tensor): [n, 6 + mask_dim] detections in network input coordinates.
+            img_shape (tuple): (h, w) of the network input.
+            orig_shape (tuple): (h, w) of the original image.
+            topk (int): number of candidates kept per box. FastSAMPrompt.box_prompt picks the final mask
+                among them at full resolution.
+
+        Returns:
+            (torch.Tensor): indices into pred.
+        """
+        c, mh, mw = proto.shape
+        ih, iw = img_shape
+        masks = (pred[:, 6:] @ proto.float().view(c, -1)).sigmoid().view(-1, mh, mw)
+        downsampled_bboxes = pred[:, :4].clone()
+        downsampled_bboxes[:, [0, 2]] *= mw / iw
+        downsampled_bboxes[:, [1, 3]] *= mh / ih
+        masks = ops.crop_mask(masks, downsampled_bboxes)
+
+        # original image -> letterboxed network input -> prototype coordinates, inverse of ops.scale_boxes
+        gain = min(ih / orig_shape[0], iw / orig_shape[1])
+        pad = round((iw - orig_shape[1] * gain) / 2 - 0.1), round((ih - orig_shape[0] * gain) / 2 - 0.1)
+
+        def to_proto(x, y):
+            px = min(max(int((x * gain + pad[0]) * mw / iw), 0), mw)
+            py = min(max(int((y * gain + pad[1]) * mh / ih), 0), mh)
+            return px, py
+
+        bboxes = self.prompts.get('bboxes')
+        points = self.prompts.get('points')
+        if bboxes is not None:
+            binary = masks > 0.5
+            masks_area = binary.sum(dim=(1, 2))
+            keep = []
+            for bbox in bboxes:
+                x1, y1 = to_proto(bbox[0], bbox[1])
+                x2, y2 = to_proto(bbox[2], bbox[3])
+                bbox_area = (x2 - x1) * (y2 - y1)
+                inside_area = binary[:, y1:y2, x1:x2].sum(dim=(1, 2))
+                IoUs = inside_area / (bbox_area + masks_area - inside_area).clamp(min=1)
+                keep.append(IoUs.topk(min(topk, len(IoUs)))[1])
+            return torch.unique(torch.cat(keep))
+        if points is not None:
+            # A 3x3 neighbourhood keeps masks whose border runs close to a point, point_prompt decides at full resolution
+            masks = F.max_pool2d(masks[None], kernel_size=3, stride=1, padding=1)[0]
+            hits = torch.stack([masks[:, min(py, mh - 1), min(px, mw - 1)] for px, py in (to_proto(*point) for point in points)], dim=1)
+            keep = torch.nonzero((hits > 0.5).any(dim=1)).flatten()
+            if len(keep) == 0:
+                keep = hits.max(dim=1)[0].argmax().view(1)
+            return keep
+        return torch.arange(len(pred), device=pred.device)
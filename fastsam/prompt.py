@@ -380,61 +380,68 @@ class FastSAMPrompt:
         assert bbox or bboxes
         if bboxes is None:
             bboxes = [bbox]
-        max_iou_index = []
-        for bbox in bboxes:
-            assert (bbox[2] != 0 and bbox[3] != 0)
-            masks = self.results[0].masks.data
-            target_height = self.img.shape[0]
-            target_width = self.img.shape[1]
-            h = masks.shape[1]
-            w = masks.shape[2]
-            if h != target_height or w != target_width:
-                bbox = [
-                    int(bbox[0] * w / target_width),
-                    int(bbox[1] * h / target_height),
-                    int(bbox[2] * w / target_width),
-                    int(bbox[3] * h / target_height), ]
-            bbox[0] = round(bbox[0]) if round(bbox[0]) > 0 else 0
-            bbox[1] = round(bbox[1]) if round(bbox[1]) > 0 else 0
-            bbox[2] = round(bbox[2]) if round(bbox[2]) < w else w
-            bbox[3] = round(bbox[3]) if round(bbox[3]) < h else h
-
-            # IoUs = torch.zeros(len(masks), dtype=torch.float32)
-            bbox_area = (bbox[3] - bbox[1]) * (bbox[2] - bbox[0])
-
-            masks_area = torch.sum(masks[:, bbox[1]:bbox[3], bbox[0]:bbox[2]], dim=(1, 2))
-            orig_masks_area = torch.sum(masks, dim=(1, 2))
-
-            union = bbox_area + orig_masks_area - masks_area
-            IoUs = masks_area / union
-            max_iou_index.append(int(torch.argmax(IoUs)))
-        max_iou_index = list(set(max_iou_index))
-        return np.array(masks[max_iou_index].cpu().numpy())
-
-    def point_prompt(self, points, pointlabel):  # numpy 
+        masks = self.results[0].masks.data
+        target_height = self.img.shape[0]
+        target_width = self.img.shape[1]
+        h = masks.shape[1]
+        w = masks.shape[2]
+        bboxes = torch.as_tensor(bboxes, dtype=torch.float32, device=masks.device).reshape(-1, 4)
+        assert ((bboxes[:, 2] != 0) & (bboxes[:, 3] != 0)).all()
+        if h != target_height or w != target_width:
+            bboxes = (bboxes * torch.tensor([w / target_width, h / target_height] * 2, device=masks.device)).trunc()
+        bboxes = bboxes.round().long()
+        x1, x2 = bboxes[:, 0].clamp(0, w), bboxes[:, 2].clamp(max=w)
+        y1, y2 = bboxes[:, 1].clamp(0, h), bboxes[:, 3].clamp(max=h)
+        bbox_area = (y2 - y1) * (x2 - x1)
+
+        # Summed-area table, the area of every mask inside every box takes four lookups
+        sat = torch.cumsum(masks, dim=1, dtype=torch.int32).cumsum_(dim=2)
+        orig_masks_area = sat[:, -1, -1, None]
+        masks_area = (self._sat_lookup(sat, y2, x2) - self._sat_lookup(sat, y1, x2) -
+                      self._sat_lookup(sat, y2, x1) + self._sat_lookup(sat, y1, x1))
+        del sat
+
+        union = bbox_area + orig_masks_area - masks_area
+        IoUs = masks_area / union
+        max_iou_index = torch.unique(torch.argmax(IoUs, dim=0))
+        return masks[max_iou_index]
+
+    @staticmethod
+    def _sat_lookup(sat, y, x):
+        # Mask area in [0:y, 0:x] for every mask and every y, x pair. The table has no zero row and column.
+        area = sat[:, (y - 1).clamp(min=0), (x - 1).clamp(min=0)]
+        return area * ((y > 0) & (x > 0))
+
+    def point_prompt(self, points, pointlabel):
         if self.results == None:
             return []
-        masks = self._format_results(self.results[0], 0)
+        masks = self.results[0].masks.data == 1.0
         target_height = self.img.shape[0]
         target_width = self.img.shape[1]
-        h = masks[0]['segmentation'].shape[0]
-        w = masks[0]['segmentation'].shape[1]
+        h = masks.shape[1]
+        w = masks.shape[2]
         if h != target_height or w != target_width:
             points = [[int(point[0] * w / target_width), int(point[1] * h / target_height)] for point in points]
-        onemask = np.zeros((h, w))
-        masks = sorted(masks, key=lambda x: x['area'], reverse=True)
-        for i, annotation in enumerate(masks):
-            if type(annotation) == dict:
-                mask = annotation['segmentation']
-            else:
-                mask = annotation
-            for i, point in enumerate(points):
-                if mask[point[1], point[0]] == 1 and pointlabel[i] == 1:
-                    onemask[mask] = 1
-                if mask[point[1], point[0]] == 1 and pointlabel[i] == 0:
-                    onemask[mask] = 0
-        onemask = onemask >= 1
-        return np.array([onemask])
+        points = torch.as_tensor(points, dtype=torch.long, device=masks.device)
+        pointlabel = torch.as_tensor(pointlabel, dtype=torch.long, device=masks.device)
+
+        # Largest masks first, so that smaller masks hit by a point overwrite them
+        order = torch.sort(masks.sum(dim=(1, 2)), descending=True, stable=True)[1]
+        hits = masks[:, points[:, 1], points[:, 0]][order]  # [n, p]
+        hit = hits.any(dim=1)
+        order, hits = order[hit], hits[hit]
+        if len(order) == 0:
+            return torch.zeros((1, h, w), dtype=torch.bool, device=masks.device)
+
+        # Within a mask the last point that hits it decides between foreground and background
+        last_point = hits.shape[1] - 1 - hits.flip(dims=[1]).int().argmax(dim=1)
+        labels = (pointlabel[last_point] >= 1).tolist()
+
+        # For every pixel the smallest hit mask covering it wins, only the few hit masks are read
+        onemask = torch.zeros((h, w), dtype=torch.bool, device=masks.device)
+        for index, label in zip(order.tolist(), labels):
+            onemask[masks[index]] = label
+        return onemask[None]
 
     def text_prompt(self, text):
         if self.results == None:
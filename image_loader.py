@@ -0,0 +1,141 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from mask_io import read_mask_png
+
+# cv2 decodes JPEGs at 1/2, 1/4 or 1/8 of their size almost for free, the DCT
+# is simply not evaluated for the dropped frequencies.
+REDUCED_DECODE_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+# EXIF orientations that turn the image by 90 or 270 degrees
+EXIF_ORIENTATION = 0x0112
+TRANSPOSING_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def read_image(image_path, min_size=None):
+    """Reads an image as RGB array (H, W, 3) and returns it with its original size (H, W).
+
+    With min_size set, the image is decoded at the smallest reduced resolution
+    whose longest side is still at least min_size. The returned image is then
+    smaller than the original size.
+    """
+    if min_size is not None:
+        with Image.open(image_path) as image:
+            width, height = image.size
+            # cv2 applies the EXIF orientation, rotated by 90 or 270 degrees the sides swap
+            if image.getexif().get(EXIF_ORIENTATION) in TRANSPOSING_ORIENTATIONS:
+                width, height = height, width
+        for factor, flag in REDUCED_DECODE_FLAGS:
+            if max(height, width) // factor >= min_size:
+                image = cv2.imread(image_path, flag)
+                return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), (height, width)
+    image = cv2.imread(image_path)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), image.shape[:2]
+
+
+def read_input_image(image_path, transform, reduced_decode=True):
+    """Reads an image straight into the encoder input of transform (ResizeLongestSide).
+
+    Returns the input image and the original size (H, W) of the image. With
+    reduced_decode the full resolution is never decoded for large JPEGs.
+    """
+    image, original_size = read_image(image_path, transform.target_length if reduced_decode else None)
+    return transform.apply_image(image), original_size
+
+
+def read_input_mask(mask_path, transform):
+    """Reads a mask PNG into the encoder input of transform, as SamPredictor.set_image would transform read_mask_rgb.
+
+    Only the red channel holds the mask, so only this channel is resized.
+    """
+    mask = read_mask_png(mask_path)
+    target_size = transform.get_preprocess_shape(mask.shape[0], mask.shape[1], transform.target_length)
+    red = Image.fromarray(mask.astype(np.uint8) * 128, mode='L').resize(target_size[::-1], Image.BILINEAR)
+    input_mask = np.zeros((target_size[0], target_size[1], 3), dtype=np.uint8)
+    input_mask[..., 0] = np.array(red)
+    return input_mask
+
+
+class LazyImage(object):
+    """A test image of which only the encoder input is kept in memory.
+
+    The full resolution image is read again from image_path the first time it
+    is needed, e.g. for an overlay larger than the encoder input.
+    """
+
+    def __init__(self, image_path, input_image, original_size):
+        self.image_path = image_path
+        self.input_image = input_image
+        self.original_size = tuple(original_size)
+        self.image = None
+
+    def full(self):
+        if self.image is None:
+            self.image, _ = read_image(self.image_path)
+        return self.image
+
+    def for_size(self, size):
+        """The image for drawing it with a longest side of size pixels.
+
+        The encoder input is used if the image is scaled down to size anyway and
+        the encoder input is large enough, otherwise the full resolution.
+        """
+        if max(self.original_size) > size and max(self.input_image.shape[:2]) >= size:
+            return self.input_image
+        return self.full()
+
+
+class ImagePrefetcher(object):
+    """Decodes and resizes images in background threads while the caller encodes the previous ones.
+
+    Iterating yields (file name, image, input image, original size) in the order of
+    file_names. input image is the image resized with transform (ResizeLongestSide)
+    for the encoder and original size the size (H, W) of the file. image is a LazyImage,
+    only the input image is kept and the full resolution is read again if needed.
+    At most queue_size images are loaded ahead, so the memory use stays bounded however
+    long the list is. With num_threads=0 the images are loaded in the calling thread.
+    """
+
+    def __init__(self, input_path, file_names, transform, num_threads=2, queue_size=4, reduced_decode=True):
+        self.input_path = input_path
+        self.file_names = file_names
+        self.transform = transform
+        self.num_threads = num_threads
+        self.queue_size = max(queue_size, 1)
+        self.reduced_decode = reduced_decode
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def load(self, file_name):
+        image_path = f"{self.input_path}/{file_name}"
+        input_image, original_size = read_input_image(image_path, self.transform, self.reduced_decode)
+        return file_name, LazyImage(image_path, input_image, original_size), input_image, original_size
+
+    def __iter__(self):
+        if self.num_threads <= 0:
+            for file_name in self.file_names:
+                yield self.load(file_name)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            file_names = iter(self.file_names)
+            queue = collections.deque()
+            for file_name in file_names:
+                queue.append(executor.submit(self.load, file_name))
+                if len(queue) >= self.queue_size:
+                    break
+            try:
+                while queue:
+                    loaded = queue.popleft().result()
+                    for file_name in file_names:
+                        queue.append(executor.submit(self.load, file_name))
+                        break
+                    yield loaded
+            finally:
+                for future in queue:
+                    future.cancel()
@@ -0,0 +1,89 @@
+import math
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+# The location prior of PerSAM is found on the similarity map of the image
+# embedding (64 x 64 for SAM), refined between its cells and mapped to the
+# original image with the geometry of the encoder input. Similarity maps of the
+# size of the scan are never needed.
+
+
+def refine_peak(sim, y, x):
+    """Sub-cell position (y, x) of the extremum in cell (y, x) of sim (h, w).
+
+    A parabola is laid through the cell and its two neighbours along each axis,
+    its vertex is the refined position. The offset stays within half a cell.
+    """
+    position = []
+    for index, before, center, after in (
+        (y, sim[y - 1, x] if y > 0 else None, sim[y, x], sim[y + 1, x] if y < sim.shape[0] - 1 else None),
+        (x, sim[y, x - 1] if x > 0 else None, sim[y, x], sim[y, x + 1] if x < sim.shape[1] - 1 else None),
+    ):
+        offset = 0.0
+        if before is not None and after is not None:
+            curvature = before - 2 * center + after
+            if curvature != 0:
+                offset = min(max(0.5 * (before - after) / curvature, -0.5), 0.5)
+        position.append(index + offset)
+    return position
+
+
+def select_points(sim, input_size, original_size, img_size=1024, topk=1, largest=True):
+    """Finds the topk highest (or lowest) points of a similarity map, in original image coordinates.
+
+    Args:
+        sim (torch.Tensor): Similarity map (h, w) of the image embedding. It covers the
+            padded square encoder input of img_size pixels.
+        input_size (tuple): Size (H, W) of the encoder input before padding.
+        original_size (tuple): Size (H, W) of the original image.
+        img_size (int): Side of the square encoder input.
+        topk (int): Number of points.
+        largest (bool): The highest points if True, the lowest otherwise.
+
+    Returns:
+        (np.ndarray): Points (topk, 2) as integer (x, y) pixels of the original image.
+    """
+    # The padding at the bottom and right shows no image, cells there are skipped
+    cell = img_size / sim.shape[0]
+    valid_h = min(sim.shape[0], math.ceil(input_size[0] / cell))
+    valid_w = min(sim.shape[1], math.ceil(input_size[1] / cell))
+    valid = sim[:valid_h, :valid_w].float()
+    indices = valid.flatten().topk(topk, largest=largest)[1].tolist()
+    valid = valid.cpu().numpy()
+
+    points = []
+    for index in indices:
+        y, x = refine_peak(valid, index // valid_w, index % valid_w)
+        # Cell i spans [i * cell, (i + 1) * cell) of the encoder input, pixel j of the image is centered at j + 0.5
+        original_x = (x + 0.5) * cell * original_size[1] / input_size[1] - 0.5
+        original_y = (y + 0.5) * cell * original_size[0] / input_size[0] - 0.5
+        points.append([min(max(round(original_x), 0), original_size[1] - 1), min(max(round(original_y), 0), original_size[0] - 1)])
+    return np.array(points, dtype=np.int64)
+
+
+def target_guidance(sim, input_size, img_size=1024):
+    """The target guidance of PerSAM for the cross-attention layers, from a similarity map (1, 1, h, w).
+
+    As before, the part of the map that shows the image is normalised and stretched
+    over the embedding grid, only without the detour over the original size.
+    """
+    h, w = sim.shape[-2:]
+    sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
+    cell = img_size / sim.shape[-2]
+    sim = sim[..., :math.ceil(input_size[0] / cell), :math.ceil(input_size[1] / cell)]
+    sim = (sim - sim.mean()) / torch.std(sim)
+    sim = F.interpolate(sim, size=(h, w), mode="bilinear")
+    return sim.sigmoid_().unsqueeze(0).flatten(3)
+
+
+def peak_sharpness(sim, input_size, img_size=1024):
+    """How far the highest cell of a similarity map (h, w) stands out, in standard deviations of the map.
+
+    Only the cells that show the image count. A target that is clearly found
+    gives one sharp peak, several similar places or none give a flat map.
+    """
+    cell = img_size / sim.shape[0]
+    valid = sim[:min(sim.shape[0], math.ceil(input_size[0] / cell)), :min(sim.shape[1], math.ceil(input_size[1] / cell))].float()
+    return ((valid.max() - valid.mean()) / (valid.std() + 1e-6)).item()
@@ -0,0 +1,33 @@
+import numpy as np
+from PIL import Image
+
+# Masks are stored as 1-bit palette PNGs. Index 0 is the background, index 1
+# the mask, shown in the same dark red (128, 0, 0) the masks always had.
+MASK_PALETTE = [0, 0, 0, 128, 0, 0]
+
+
+def write_mask_png(mask_path, mask):
+    """Writes a boolean mask (H, W) as 1-bit palette PNG."""
+    image = Image.fromarray(np.asarray(mask, dtype=bool).astype(np.uint8), mode='P')
+    image.putpalette(MASK_PALETTE)
+    image.save(mask_path, format='PNG', bits=1)
+
+
+def read_mask_png(mask_path):
+    """Reads a mask PNG as boolean array (H, W).
+
+    Palette masks are read by their index. Masks in any other format, like the
+    RGB masks of earlier runs, count every pixel that is not black.
+    """
+    with Image.open(mask_path) as image:
+        if image.mode in ('P', '1'):
+            return np.array(image) > 0
+        return np.array(image.convert('L')) > 0
+
+
+def read_mask_rgb(mask_path):
+    """Reads a mask PNG as RGB image (H, W, 3) with the mask in (128, 0, 0), as SamPredictor.set_image expects it."""
+    mask = read_mask_png(mask_path)
+    mask_rgb = np.zeros((mask.shape[0], mask.shape[1], 3), dtype=np.uint8)
+    mask_rgb[mask, 0] = 128
+    return mask_rgb
@@ -6,44 +6,55 @@
 
 import torch
 
+import os
+import warnings
 from functools import partial
 
 from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer, TinyViT
 
 
-def build_sam_vit_h(checkpoint=None):
+def build_sam_vit_h(checkpoint=None, inference_mode="fp32"):
     return _build_sam(
         encoder_embed_dim=1280,
         encoder_depth=32,
         encoder_num_heads=16,
         encoder_global_attn_indexes=[7, 15, 23, 31],
         checkpoint=checkpoint,
+        inference_mode=inference_mode,
     )
 
 
 build_sam = build_sam_vit_h
 
 
-def build_sam_vit_l(checkpoint=None):
+def build_sam_vit_l(checkpoint=None, inference_mode="fp32"):
     return _build_sam(
         encoder_embed_dim=1024,
         encoder_depth=24,
         encoder_num_heads=16,
         encoder_global_attn_indexes=[5, 11, 17, 23],
         checkpoint=checkpoint,
+        inference_mode=inference_mode,
     )
 
 
-def build_sam_vit_b(checkpoint=None):
+def build_sam_vit_b(checkpoint=None, inference_mode="fp32"):
     return _build_sam(
         encoder_embed_dim=768,
         encoder_depth=12,
         encoder_num_heads=12,
         encoder_global_attn_indexes=[2, 5, 8, 11],
         checkpoint=checkpoint,
+        inference_mode=inference_mode,
     )
 
-def build_sam_vit_t(checkpoint=None):
+def build_sam_vit_t(checkpoint=None, inference_mode="fp32", fuse=False):
+    """
+    MobileSAM with the TinyViT image encoder. With fuse=True the BatchNorm layers of
+    the encoder are folded into its convolutions after the checkpoint is loaded. This
+    is faster for inference, but the fused model cannot load a MobileSAM checkpoint
+    with load_state_dict any more and must not be trained.
+    """
     prompt_embed_dim = 256
     image_size = 1024
     vit_patch_size = 16
@@ -87,9 +98,11 @@ def build_sam_vit_t(checkpoint=None):
     mobile_sam.eval()
     if checkpoint is not None:
         with open(checkpoint, "rb") as f:
-            state_dict = torch.load(f)
+            state_dict = torch.load(f, map_location="cpu")
         mobile_sam.load_state_dict(state_dict)
-    return mobile_sam
+    if fuse:
+        mobile_sam.image_encoder.fuse()
+    return _apply_inference_mode(mobile_sam, inference_mode)
 
 sam_model_registry = {
     "default": build_sam_vit_h,
@@ -100,12 +113,28 @@ sam_model_registry = {
 }
 
 
+def checkpoint_model_type(checkpoint):
+    """
+    The model type of a checkpoint, guessed from the names of the released
+    files: 'mobile_sam.pt' is vit_t, 'sam_vit_b_01ec64.pth' vit_b and so on.
+    Other names are taken as vit_h.
+    """
+    name = os.path.basename(checkpoint)
+    if name.startswith("mobile_sam"):
+        return "vit_t"
+    for model_type in ("vit_b", "vit_l", "vit_h"):
+        if model_type in name:
+            return model_type
+    return "vit_h"
+
+
 def _build_sam(
     encoder_embed_dim,
     encoder_depth,
     encoder_num_heads,
     encoder_global_attn_indexes,
     checkpoint=None,
+    inference_mode="fp32",
 ):
     prompt_embed_dim = 256
     image_size = 1024
@@ -150,6 +179,30 @@ def _build_sam(
     sam.eval()
     if checkpoint is not None:
         with open(checkpoint, "rb") as f:
-            state_dict = torch.load(f)
+            state_dict = torch.load(f, map_location="cpu")
         sam.load_state_dict(state_dict)
+    return _apply_inference_mode(sam, inference_mode)
+
+
+# Precision of the image encoder, which takes almost all of the inference time on a CPU:
+#   fp32: the checkpoint as it is.
+#   int8: dynamic int8 quantization of all linear layers of the image encoder, i.e. qkv,
+#         proj and the MLPs of every block. Quantized models only run on the CPU.
+#   bf16: the image encoder runs under bfloat16 autocast, on CPUs with native bfloat16
+#         support (AVX512-BF16 or AMX). Falls back to fp32 on other CPUs.
+INFERENCE_MODES = ("fp32", "int8", "bf16")
+
+
+def _apply_inference_mode(sam, inference_mode):
+    assert inference_mode in INFERENCE_MODES, f"inference_mode must be in {INFERENCE_MODES}, is {inference_mode}."
+    if inference_mode == "int8":
+        sam.image_encoder = torch.ao.quantization.quantize_dynamic(
+            sam.image_encoder, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    elif inference_mode == "bf16":
+        bf16_supported = getattr(torch.ops.mkldnn, "_is_mkldnn_bf16_supported", None)
+        if bf16_supported is None or not bf16_supported():
+            warnings.warn("This CPU has no native bfloat16 support, the image encoder runs in fp32.")
+            inference_mode = "fp32"
+    sam.inference_mode = inference_mode
     return sam
@@ -8,10 +8,16 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from typing import Optional, Tuple, Type
+from typing import Dict, Optional, Tuple, Type
 
 from .common import LayerNorm2d, MLPBlock
 
+# "sdpa" runs the attention with torch.nn.functional.scaled_dot_product_attention (PyTorch 2.0
+# and later), which never materialises the softmax of the attention matrix. "math" is the
+# original explicit softmax(q @ k^T) @ v.
+ATTENTION_BACKENDS = ("math", "sdpa")
+DEFAULT_ATTENTION_BACKEND = "sdpa" if hasattr(F, "scaled_dot_product_attention") else "math"
+
 
 # This class and its supporting functions below lightly adapted from the ViTDet backbone available at: https://github.com/facebookresearch/detectron2/blob/main/detectron2/modeling/backbone/vit.py # noqa
 class ImageEncoderViT(nn.Module):
@@ -33,6 +39,7 @@ class ImageEncoderViT(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         global_attn_indexes: Tuple[int, ...] = (),
+        attention_backend: str = DEFAULT_ATTENTION_BACKEND,
     ) -> None:
         """
         Args:
@@ -51,6 +58,7 @@ class ImageEncoderViT(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             window_size (int): Window size for window attention blocks.
             global_attn_indexes (list): Indexes for blocks using global attention.
+            attention_backend (str): How the attention is computed, one of ATTENTION_BACKENDS.
         """
         super().__init__()
         self.img_size = img_size
@@ -82,6 +90,7 @@ class ImageEncoderViT(nn.Module):
                 rel_pos_zero_init=rel_pos_zero_init,
                 window_size=window_size if i not in global_attn_indexes else 0,
                 input_size=(img_size // patch_size, img_size // patch_size),
+                attention_backend=attention_backend,
             )
             self.blocks.append(block)
 
@@ -131,6 +140,7 @@ class Block(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         input_size: Optional[Tuple[int, int]] = None,
+        attention_backend: str = DEFAULT_ATTENTION_BACKEND,
     ) -> None:
         """
         Args:
@@ -146,6 +156,7 @@ class Block(nn.Module):
                 use global attention.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            attention_backend (str): How the attention is computed, one of ATTENTION_BACKENDS.
         """
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -156,6 +167,7 @@ class Block(nn.Module):
             use_rel_pos=use_rel_pos,
             rel_pos_zero_init=rel_pos_zero_init,
             input_size=input_size if window_size == 0 else (window_size, window_size),
+            attention_backend=attention_backend,
         )
 
         self.norm2 = norm_layer(dim)
@@ -193,6 +205,7 @@ class Attention(nn.Module):
         use_rel_pos: bool = False,
         rel_pos_zero_init: bool = True,
         input_size: Optional[Tuple[int, int]] = None,
+        attention_backend: str = DEFAULT_ATTENTION_BACKEND,
     ) -> None:
         """
         Args:
@@ -203,8 +216,11 @@ class Attention(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            attention_backend (str): How the attention is computed, one of ATTENTION_BACKENDS.
         """
         super().__init__()
+        assert attention_backend in ATTENTION_BACKENDS, f"Unknown attention backend {attention_backend}."
+        self.attention_backend = attention_backend
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = head_dim**-0.5
@@ -220,6 +236,38 @@ class Attention(nn.Module):
             # initialize relative positional embeddings
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
+        self.rel_pos_tables: Dict[Tuple[Tuple[int, int], Tuple[int, int]], tuple] = {}
+
+    def get_rel_pos_tables(
+        self, q_size: Tuple[int, int], k_size: Tuple[int, int]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        The tables Rh and Rw of get_rel_pos for the given query and key sizes.
+        For inference they are built once per sizes and kept. They are built
+        again when the embeddings were loaded or changed (their version
+        counter), moved or cast.
+        """
+        if self.training:
+            return (
+                get_rel_pos(q_size[0], k_size[0], self.rel_pos_h),
+                get_rel_pos(q_size[1], k_size[1], self.rel_pos_w),
+            )
+        key = (
+            self.rel_pos_h.device,
+            self.rel_pos_h.dtype,
+            self.rel_pos_h._version,
+            self.rel_pos_w._version,
+        )
+        cached = self.rel_pos_tables.get((q_size, k_size))
+        if cached is None or cached[0] != key:
+            with torch.no_grad():
+                cached = (
+                    key,
+                    get_rel_pos(q_size[0], k_size[0], self.rel_pos_h),
+                    get_rel_pos(q_size[1], k_size[1], self.rel_pos_w),
+                )
+            self.rel_pos_tables[(q_size, k_size)] = cached
+        return cached[1], cached[2]
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, H, W, _ = x.shape
@@ -228,13 +276,26 @@ class Attention(nn.Module):
         # q, k, v with shape (B * nHead, H * W, C)
         q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
 
-        attn = (q * self.scale) @ k.transpose(-2, -1)
-
-        if self.use_rel_pos:
-            attn = add_decomposed_rel_pos(attn, q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
-
-        attn = attn.softmax(dim=-1)
-        x = (attn @ v).view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+        if self.attention_backend == "sdpa":
+            # The relative position bias goes in as additive mask, its scale is that of the attention
+            attn_mask = None
+            if self.use_rel_pos:
+                attn_mask = get_decomposed_rel_pos(
+                    q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W), self.get_rel_pos_tables((H, W), (H, W))
+                ).to(q.dtype)
+            x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+        else:
+            attn = (q * self.scale) @ k.transpose(-2, -1)
+
+            if self.use_rel_pos:
+                attn = add_decomposed_rel_pos(
+                    attn, q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W), self.get_rel_pos_tables((H, W), (H, W))
+                )
+
+            attn = attn.softmax(dim=-1)
+            x = attn @ v
+
+        x = x.view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
         x = self.proj(x)
 
         return x
@@ -322,6 +383,42 @@ def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor
     return rel_pos_resized[relative_coords.long()]
 
 
+def decomposed_rel_pos_terms(
+    q: torch.Tensor,
+    rel_pos_h: torch.Tensor,
+    rel_pos_w: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+    rel_pos_tables: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    The height and width terms of the decomposed relative positional embeddings.
+    Args:
+        q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
+        rel_pos_h (Tensor): relative position embeddings (Lh, C) for height axis.
+        rel_pos_w (Tensor): relative position embeddings (Lw, C) for width axis.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+        rel_pos_tables (Tuple or None): the tables (Rh, Rw) of get_rel_pos for these
+            sizes if they are already built, e.g. by Attention.get_rel_pos_tables.
+
+    Returns:
+        rel_h (Tensor): height term with shape (B, q_h, q_w, k_h).
+        rel_w (Tensor): width term with shape (B, q_h, q_w, k_w).
+    """
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+    if rel_pos_tables is None:
+        rel_pos_tables = (get_rel_pos(q_h, k_h, rel_pos_h), get_rel_pos(q_w, k_w, rel_pos_w))
+    Rh, Rw = rel_pos_tables
+
+    B, _, dim = q.shape
+    r_q = q.reshape(B, q_h, q_w, dim)
+    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
+    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+    return rel_h, rel_w
+
+
 def add_decomposed_rel_pos(
     attn: torch.Tensor,
     q: torch.Tensor,
@@ -329,6 +426,7 @@ def add_decomposed_rel_pos(
     rel_pos_w: torch.Tensor,
     q_size: Tuple[int, int],
     k_size: Tuple[int, int],
+    rel_pos_tables: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
 ) -> torch.Tensor:
     """
     Calculate decomposed Relative Positional Embeddings from :paper:`mvitv2`.
@@ -340,20 +438,17 @@ def add_decomposed_rel_pos(
         rel_pos_w (Tensor): relative position embeddings (Lw, C) for width axis.
         q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
         k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+        rel_pos_tables (Tuple or None): the tables (Rh, Rw) of get_rel_pos for these
+            sizes if they are already built, e.g. by Attention.get_rel_pos_tables.
 
     Returns:
         attn (Tensor): attention map with added relative positional embeddings.
     """
     q_h, q_w = q_size
     k_h, k_w = k_size
-    Rh = get_rel_pos(q_h, k_h, rel_pos_h)
-    Rw = get_rel_pos(q_w, k_w, rel_pos_w)
-
-    B, _, dim = q.shape
-    r_q = q.reshape(B, q_h, q_w, dim)
-    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
-    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+    rel_h, rel_w = decomposed_rel_pos_terms(q, rel_pos_h, rel_pos_w, q_size, k_size, rel_pos_tables)
 
+    B = q.shape[0]
     attn = (
         attn.view(B, q_h, q_w, k_h, k_w) + rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]
     ).view(B, q_h * q_w, k_h * k_w)
@@ -361,6 +456,39 @@ def add_decomposed_rel_pos(
     return attn
 
 
+def get_decomposed_rel_pos(
+    q: torch.Tensor,
+    rel_pos_h: torch.Tensor,
+    rel_pos_w: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+    rel_pos_tables: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+) -> torch.Tensor:
+    """
+    The decomposed relative positional embeddings of add_decomposed_rel_pos as
+    additive attention mask, for scaled_dot_product_attention.
+    Args:
+        q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
+        rel_pos_h (Tensor): relative position embeddings (Lh, C) for height axis.
+        rel_pos_w (Tensor): relative position embeddings (Lw, C) for width axis.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+        rel_pos_tables (Tuple or None): the tables (Rh, Rw) of get_rel_pos for these
+            sizes if they are already built, e.g. by Attention.get_rel_pos_tables.
+
+    Returns:
+        attn_mask (Tensor): attention bias with shape (B, q_h * q_w, k_h * k_w).
+    """
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+    rel_h, rel_w = decomposed_rel_pos_terms(q, rel_pos_h, rel_pos_w, q_size, k_size, rel_pos_tables)
+
+    B = q.shape[0]
+    attn_mask = (rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]).reshape(B, q_h * q_w, k_h * k_w)
+
+    return attn_mask
+
+
 class PatchEmbed(nn.Module):
     """
     Image to Patch Embedding.
@@ -18,6 +18,8 @@ from .prompt_encoder import PromptEncoder
 class Sam(nn.Module):
     mask_threshold: float = 0.0
     image_format: str = "RGB"
+    # "fp32", or "bf16" to run the image encoder under bfloat16 autocast, see build_sam
+    inference_mode: str = "fp32"
 
     def __init__(
         self,
@@ -95,7 +97,7 @@ class Sam(nn.Module):
                 to subsequent iterations of prediction.
         """
         input_images = torch.stack([self.preprocess(x["image"]) for x in batched_input], dim=0)
-        image_embeddings = self.image_encoder(input_images)
+        image_embeddings = self.encode_images(input_images)
 
         outputs = []
         for image_record, curr_embedding in zip(batched_input, image_embeddings):
@@ -130,6 +132,17 @@ class Sam(nn.Module):
             )
         return outputs
 
+    def encode_images(self, input_images: torch.Tensor) -> torch.Tensor:
+        """
+        Runs the image encoder on preprocessed images in BxCxHxW format. In
+        the "bf16" inference mode the encoder runs under bfloat16 autocast,
+        the embeddings are always returned as float32.
+        """
+        if self.inference_mode == "bf16":
+            with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
+                return self.image_encoder(input_images).float()
+        return self.image_encoder(input_images)
+
     def postprocess_masks(
         self,
         masks: torch.Tensor,
@@ -250,10 +250,21 @@ class Attention(torch.nn.Module):
     @torch.no_grad()
     def train(self, mode=True):
         super().train(mode)
-        if mode and hasattr(self, 'ab'):
-            del self.ab
-        else:
-            self.ab = self.attention_biases[:, self.attention_bias_idxs]
+        self.ab = None
+        self.ab_key = None
+        return self
+
+    def get_attention_biases(self):
+        # The bias table is gathered once and kept for inference. It is gathered again
+        # when the biases were loaded or changed (their version counter), moved or cast.
+        if self.training:
+            return self.attention_biases[:, self.attention_bias_idxs]
+        key = (self.attention_biases.device, self.attention_biases.dtype, self.attention_biases._version)
+        if getattr(self, 'ab_key', None) != key:
+            with torch.no_grad():
+                self.ab = self.attention_biases[:, self.attention_bias_idxs]
+            self.ab_key = key
+        return self.ab
 
     def forward(self, x):  # x (B,N,C)
         B, N, _ = x.shape
@@ -273,8 +284,7 @@ class Attention(torch.nn.Module):
         attn = (
             (q @ k.transpose(-2, -1)) * self.scale
             +
-            (self.attention_biases[:, self.attention_bias_idxs]
-             if self.training else self.ab)
+            self.get_attention_biases()
         )
         attn = attn.softmax(dim=-1)
         x = (attn @ v).transpose(1, 2).reshape(B, N, self.dh)
@@ -595,6 +605,17 @@ class TinyViT(nn.Module):
     def no_weight_decay_keywords(self):
         return {'attention_biases'}
 
+    @torch.no_grad()
+    def fuse(self):
+        # Folds the BatchNorm of every Conv2d_BN into its convolution. The BatchNorm
+        # statistics are frozen afterwards, so this is for inference only.
+        for module in list(self.modules()):
+            for name, child in list(module.named_children()):
+                if isinstance(child, Conv2d_BN):
+                    fused = child.fuse().to(child.c.weight.device)
+                    setattr(module, name, fused.train(child.training))
+        return self
+
     def forward_features(self, x):
         # x: (N, C, H, W)
         x = self.patch_embed(x)
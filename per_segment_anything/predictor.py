@@ -7,8 +7,9 @@
 import numpy as np
 import torch
 
-from typing import Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
+from .utils.embedding_cache import EmbeddingCache
 from .utils.transforms import ResizeLongestSide
 
 
@@ -16,6 +17,7 @@ class SamPredictor:
     def __init__(
         self,
         sam_model,
+        embedding_cache: Optional[EmbeddingCache] = None,
     ) -> None:
         """
         Uses SAM to calculate the image embedding for an image, and then
@@ -23,9 +25,13 @@ class SamPredictor:
 
         Arguments:
           sam_model (Sam): The model to use for mask prediction.
+          embedding_cache (EmbeddingCache or None): If set, image embeddings
+            are looked up in and stored to this cache instead of always
+            running the image encoder.
         """
         super().__init__()
         self.model = sam_model
+        self.embedding_cache = embedding_cache
         self.transform = ResizeLongestSide(sam_model.image_encoder.img_size)
         self.reset_image()
 
@@ -34,7 +40,8 @@ class SamPredictor:
         image: np.ndarray,
         mask: np.ndarray = None,
         image_format: str = "RGB",
-        cal_image=True
+        cal_image=True,
+        original_size: Optional[Tuple[int, ...]] = None,
     ) -> None:
         """
         Calculates the image embeddings for the provided image, allowing
@@ -44,6 +51,10 @@ class SamPredictor:
           image (np.ndarray): The image for calculating masks. Expects an
             image in HWC uint8 format, with pixel values in [0, 255].
           image_format (str): The color format of the image, in ['RGB', 'BGR'].
+          original_size (tuple(int, int) or None): If set, the image and the
+            mask are already transformed with 'self.transform.apply_image',
+            e.g. decoded at reduced resolution, and this is the size in
+            (H, W) format of the full image the masks are predicted for.
         """
         assert image_format in [
             "RGB",
@@ -52,19 +63,37 @@ class SamPredictor:
         if image_format != self.model.image_format:
             image = image[..., ::-1]
 
+        # Look up the embedding before resizing, a hit makes the transform unnecessary
+        cache_key = None
+        if cal_image and self.embedding_cache is not None:
+            if original_size is None:
+                cache_key = self.embedding_cache.get_key(image, self.model.image_encoder.img_size)
+            else:
+                cache_key = self.embedding_cache.get_key(image, self.model.image_encoder.img_size, tuple(original_size))
+            if self._load_cached_embedding(cache_key):
+                cal_image = False
+
         # Transform the image to the form expected by the model
-        input_image = self.transform.apply_image(image)
-        input_image_torch = torch.as_tensor(input_image, device=self.device)
-        input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+        input_image_torch = None
+        if cal_image:
+            input_image = self.transform.apply_image(image) if original_size is None else image
+            input_image_torch = torch.as_tensor(input_image, device=self.device)
+            input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
 
         # Transform the mask to the form expected by the model
         input_mask_torch = None
         if mask is not None:
-          input_mask = self.transform.apply_image(mask)
+          input_mask = self.transform.apply_image(mask) if original_size is None else mask
           input_mask_torch = torch.as_tensor(input_mask, device=self.device)
           input_mask_torch = input_mask_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
 
-        input_mask = self.set_torch_image(input_image_torch, image.shape[:2], transformed_mask=input_mask_torch)
+        input_mask = self.set_torch_image(
+            input_image_torch,
+            image.shape[:2] if original_size is None else tuple(original_size),
+            transformed_mask=input_mask_torch,
+            cal_image=cal_image,
+            cache_key=cache_key,
+        )
         return input_mask
           
 
@@ -74,7 +103,8 @@ class SamPredictor:
         transformed_image: torch.Tensor,
         original_image_size: Tuple[int, ...],
         transformed_mask: torch.Tensor = None,
-        cal_image=True
+        cal_image=True,
+        cache_key: Optional[str] = None,
     ) -> None:
         """
         Calculates the image embeddings for the provided image, allowing
@@ -86,25 +116,131 @@ class SamPredictor:
             1x3xHxW, which has been transformed with ResizeLongestSide.
           original_image_size (tuple(int, int)): The size of the image
             before transformation, in (H, W) format.
+          cache_key (str or None): The embedding cache key of the image. If
+            None and an embedding cache is set, it is computed from
+            transformed_image.
         """
-        assert (
-            len(transformed_image.shape) == 4
-            and transformed_image.shape[1] == 3
-            and max(*transformed_image.shape[2:]) == self.model.image_encoder.img_size
-        ), f"set_torch_image input must be BCHW with long side {self.model.image_encoder.img_size}."
-        
         if cal_image:
-          self.reset_image()
-          self.original_size = original_image_size
-          self.input_size = tuple(transformed_image.shape[-2:])
-          input_image = self.model.preprocess(transformed_image)
-          self.features = self.model.image_encoder(input_image)
-          self.is_image_set = True
+          assert (
+              len(transformed_image.shape) == 4
+              and transformed_image.shape[1] == 3
+              and max(*transformed_image.shape[2:]) == self.model.image_encoder.img_size
+          ), f"set_torch_image input must be BCHW with long side {self.model.image_encoder.img_size}."
+
+          if cache_key is None and self.embedding_cache is not None:
+            cache_key = self.embedding_cache.get_key(
+                transformed_image, self.model.image_encoder.img_size, tuple(original_image_size)
+            )
+          if cache_key is None or not self._load_cached_embedding(cache_key):
+            self.reset_image()
+            self.original_size = original_image_size
+            self.input_size = tuple(transformed_image.shape[-2:])
+            input_image = self.model.preprocess(transformed_image)
+            self.features = self.model.encode_images(input_image)
+            self.is_image_set = True
+            if cache_key is not None:
+              self.embedding_cache.save(cache_key, self.features, self.input_size, self.original_size)
 
         if transformed_mask is not None:
           input_mask = self.model.preprocess(transformed_mask)  # pad to 1024
           return input_mask
 
+    @torch.no_grad()
+    def encode_batch(
+        self,
+        images: List[np.ndarray],
+        image_format: str = "RGB",
+        batch_size: int = 4,
+        original_sizes: Optional[List[Tuple[int, ...]]] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Calculates the image embeddings for several images, running the image
+        encoder on up to batch_size images at once. The current image of the
+        predictor is not changed, use 'set_embedding' to select one of the
+        returned embeddings for mask prediction.
+
+        Arguments:
+          images (list(np.ndarray)): The images, each in HWC uint8 format
+            with pixel values in [0, 255]. The images may differ in size.
+          image_format (str): The color format of the images, in ['RGB', 'BGR'].
+          batch_size (int): The number of images encoded in one forward pass.
+          original_sizes (list(tuple(int, int)) or None): If set, the images
+            are already transformed with 'self.transform.apply_image', e.g.
+            by a background loader, and these are the sizes in (H, W) format
+            of the images they were resized from.
+
+        Returns:
+          (list(dict)): One dictionary per image with the keys 'features'
+            (torch.Tensor of shape 1xCxHxW), 'input_size' and 'original_size'.
+        """
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        img_size = self.model.image_encoder.img_size
+
+        embeddings: List[Optional[Dict[str, Any]]] = [None] * len(images)
+        cache_keys: List[Optional[str]] = [None] * len(images)
+        pending = []
+        for i, image in enumerate(images):
+            if image_format != self.model.image_format:
+                image = image[..., ::-1]
+            if self.embedding_cache is not None:
+                if original_sizes is None:
+                    cache_keys[i] = self.embedding_cache.get_key(image, img_size)
+                else:
+                    cache_keys[i] = self.embedding_cache.get_key(image, img_size, tuple(original_sizes[i]))
+                cached = self.embedding_cache.load(cache_keys[i], self.device)
+                if cached is not None:
+                    features, input_size, original_size = cached
+                    embeddings[i] = {
+                        "features": features,
+                        "input_size": input_size,
+                        "original_size": original_size,
+                    }
+                    continue
+            pending.append((i, image))
+
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start : start + batch_size]
+            input_images, sizes = [], []
+            for i, image in chunk:
+                if original_sizes is None:
+                    input_image = self.transform.apply_image(image)
+                    original_size = image.shape[:2]
+                else:
+                    input_image = image
+                    original_size = tuple(original_sizes[i])
+                input_image_torch = torch.as_tensor(input_image, device=self.device)
+                input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+                sizes.append((tuple(input_image_torch.shape[-2:]), original_size))
+                # Sam.preprocess pads every image to the square encoder input, so they can be stacked
+                input_images.append(self.model.preprocess(input_image_torch))
+            features = self.model.encode_images(torch.cat(input_images, dim=0))
+
+            for (i, _), curr_features, (input_size, original_size) in zip(chunk, features, sizes):
+                curr_features = curr_features.unsqueeze(0)
+                embeddings[i] = {
+                    "features": curr_features,
+                    "input_size": input_size,
+                    "original_size": original_size,
+                }
+                if cache_keys[i] is not None:
+                    self.embedding_cache.save(cache_keys[i], curr_features, input_size, original_size)
+
+        return embeddings
+
+    def set_embedding(self, embedding: Dict[str, Any]) -> None:
+        """
+        Sets the current image from an embedding returned by 'encode_batch',
+        allowing masks to be predicted with the 'predict' method.
+        """
+        self.reset_image()
+        self.features = embedding["features"]
+        self.input_size = embedding["input_size"]
+        self.original_size = embedding["original_size"]
+        self.is_image_set = True
+
     def predict(
         self,
         point_coords: Optional[np.ndarray] = None,
@@ -186,6 +322,109 @@ class SamPredictor:
 
         return masks, iou_predictions, low_res_masks, high_res_masks
 
+    def predict_batch(
+        self,
+        point_coords: Optional[List[np.ndarray]] = None,
+        point_labels: Optional[List[np.ndarray]] = None,
+        boxes: Optional[np.ndarray] = None,
+        mask_input: Optional[np.ndarray] = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+        attn_sim=None,
+        target_embedding=None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, torch.Tensor]:
+        """
+        Predict masks for B prompt sets against the currently set image in one
+        pass of the prompt encoder and mask decoder, e.g. for several candidate
+        location priors. The image embedding is broadcast over the prompt sets,
+        not copied for each of them.
+
+        Arguments:
+          point_coords (list(np.ndarray) or None): B arrays of point prompts,
+            the b-th with shape N_bx2. Each point is in (X,Y) in pixels. The
+            sets may differ in length, shorter sets are padded with points of
+            label -1, which SAM treats as no point. Like the padding point the
+            prompt encoder adds itself, they can still shift the masks of a
+            padded set slightly.
+          point_labels (list(np.ndarray) or None): B arrays of labels for the
+            point prompts, the b-th of length N_b. 1 indicates a foreground
+            point and 0 indicates a background point.
+          boxes (np.ndarray or None): A Bx4 array of box prompts, one per
+            prompt set, in XYXY format.
+          mask_input (np.ndarray or None): Low resolution mask inputs of form
+            Bx1xHxW, where for SAM, H=W=256.
+          multimask_output (bool): If true, the model will return three masks
+            per prompt set. See predict.
+          return_logits (bool): If true, returns un-thresholded masks logits
+            instead of binary masks.
+          attn_sim (torch.Tensor or None): The target guidance of PerSAM, shared
+            by all prompt sets.
+          target_embedding (torch.Tensor or None): The target embedding of
+            PerSAM, shared by all prompt sets.
+
+        Returns:
+          (np.ndarray): The output masks in BxCxHxW format, where C is the
+            number of masks, and (H, W) is the original image size.
+          (np.ndarray): An array of shape BxC containing the model's
+            predictions for the quality of each mask.
+          (np.ndarray): An array of shape BxCxHxW, where C is the number
+            of masks and H=W=256. These low resolution logits can be passed to
+            a subsequent iteration as mask input.
+          (torch.Tensor): The mask logits in BxCxHxW format at the original
+            image size.
+        """
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        # Transform and pad input prompts
+        coords_torch, labels_torch, box_torch, mask_input_torch = None, None, None, None
+        if point_coords is not None:
+            assert (
+                point_labels is not None
+            ), "point_labels must be supplied if point_coords is supplied."
+            coords_torch, labels_torch = self._pad_points(point_coords, point_labels)
+        if boxes is not None:
+            boxes = self.transform.apply_boxes(np.asarray(boxes), self.original_size)
+            box_torch = torch.as_tensor(boxes, dtype=torch.float, device=self.device)
+        if mask_input is not None:
+            mask_input_torch = torch.as_tensor(mask_input, dtype=torch.float, device=self.device)
+        masks, iou_predictions, low_res_masks, high_res_masks = self.predict_torch(
+            coords_torch,
+            labels_torch,
+            box_torch,
+            mask_input_torch,
+            multimask_output,
+            return_logits=return_logits,
+            attn_sim=attn_sim,
+            target_embedding=target_embedding,
+        )
+
+        masks = masks.detach().cpu().numpy()
+        iou_predictions = iou_predictions.detach().cpu().numpy()
+        low_res_masks = low_res_masks.detach().cpu().numpy()
+        return masks, iou_predictions, low_res_masks, high_res_masks
+
+    def _pad_points(
+        self, point_coords: List[np.ndarray], point_labels: List[np.ndarray]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Transforms B point sets of any length to the input frame and pads them
+        with label -1 points to BxNx2 coordinates and BxN labels.
+        """
+        num_points = max(len(coords) for coords in point_coords)
+        coords_padded = np.zeros((len(point_coords), num_points, 2), dtype=np.float32)
+        labels_padded = -np.ones((len(point_coords), num_points), dtype=np.int32)
+        for i, (coords, labels) in enumerate(zip(point_coords, point_labels)):
+            if len(coords) > 0:
+                coords_padded[i, : len(coords)] = self.transform.apply_coords(
+                    np.asarray(coords, dtype=np.float32), self.original_size
+                )
+            labels_padded[i, : len(labels)] = labels
+        return (
+            torch.as_tensor(coords_padded, device=self.device),
+            torch.as_tensor(labels_padded, device=self.device),
+        )
+
     @torch.no_grad()
     def predict_torch(
         self,
@@ -236,6 +475,31 @@ class SamPredictor:
         if not self.is_image_set:
             raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
 
+        low_res_masks, iou_predictions = self._decode(
+            point_coords, point_labels, boxes, mask_input, multimask_output, attn_sim, target_embedding
+        )
+
+        # Upscale the masks to the original image resolution
+        high_res_masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+
+        if not return_logits:
+            masks = high_res_masks > self.model.mask_threshold  # 0.0
+            return masks, iou_predictions, low_res_masks, high_res_masks 
+        else:
+            return high_res_masks, iou_predictions, low_res_masks, high_res_masks 
+        
+
+    def _decode(
+        self,
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor],
+        mask_input: Optional[torch.Tensor],
+        multimask_output: bool,
+        attn_sim=None,
+        target_embedding=None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Runs the prompt encoder and the mask decoder, returning the low res logits and the quality predictions."""
         if point_coords is not None:
             points = (point_coords, point_labels)
         else:
@@ -247,9 +511,12 @@ class SamPredictor:
             boxes=boxes,
             masks=mask_input,
         )
+        if mask_input is None:
+            # The no-mask embedding is the same for all prompts, the decoder broadcasts it with the image embedding
+            dense_embeddings = dense_embeddings[:1]
 
         # Predict masks
-        low_res_masks, iou_predictions = self.model.mask_decoder(
+        return self.model.mask_decoder(
             image_embeddings=self.features,
             image_pe=self.model.prompt_encoder.get_dense_pe(),
             sparse_prompt_embeddings=sparse_embeddings,
@@ -259,15 +526,98 @@ class SamPredictor:
             target_embedding=target_embedding
         )
 
-        # Upscale the masks to the original image resolution
-        high_res_masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+    @torch.no_grad()
+    def predict_cascade(
+        self,
+        point_coords: np.ndarray,
+        point_labels: np.ndarray,
+        mask_weights: Optional[torch.Tensor] = None,
+        attn_sim=None,
+        target_embedding=None,
+    ) -> Tuple[np.ndarray, float, int]:
+        """
+        Predicts a mask with the cascaded post-refinement of PerSAM: a first
+        prediction from the point prompts, followed by two refinements that
+        add the logits of the previous mask and the box around it as prompts.
+        All steps work on the low resolution logits and boxes are taken from
+        the low resolution masks, only the final mask is upscaled to the
+        original image size.
 
-        if not return_logits:
-            masks = high_res_masks > self.model.mask_threshold  # 0.0
-            return masks, iou_predictions, low_res_masks, high_res_masks 
+        Arguments:
+          point_coords (np.ndarray): A Nx2 array of point prompts to the
+            model. Each point is in (X,Y) in pixels of the original image.
+          point_labels (np.ndarray): A length N array of labels for the
+            point prompts.
+          mask_weights (torch.Tensor or None): If set (PerSAM-F), the first
+            step predicts three masks and sums their logits with these
+            weights, and the first refinement gets the box of this mask.
+            Otherwise (PerSAM) the first step predicts a single mask and the
+            first refinement only gets its logits.
+          attn_sim (torch.Tensor or None): The target guidance of PerSAM for
+            the first step.
+          target_embedding (torch.Tensor or None): The target embedding of
+            PerSAM for the first step.
+
+        Returns:
+          (np.ndarray): The final mask in HxW format, where (H, W) is the
+            original image size.
+          (float): The model's prediction for the quality of the final mask.
+          (int): The index of the final mask among the masks of the last step.
+        """
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        point_coords = self.transform.apply_coords(point_coords, self.original_size)
+        coords_torch = torch.as_tensor(point_coords, dtype=torch.float, device=self.device)[None, :, :]
+        labels_torch = torch.as_tensor(point_labels, dtype=torch.int, device=self.device)[None, :]
+
+        # First-step prediction
+        if mask_weights is None:
+            logits, _ = self._decode(
+                coords_torch, labels_torch, None, None, False, attn_sim, target_embedding
+            )
+            logit = logits[:, :1]
+            box = None
         else:
-            return high_res_masks, iou_predictions, low_res_masks, high_res_masks 
-        
+            logits, _ = self._decode(
+                coords_torch, labels_torch, None, None, True, attn_sim, target_embedding
+            )
+            logit = (logits * mask_weights.reshape(1, -1, 1, 1)).sum(1, keepdim=True)
+            box = self._low_res_box(logit[0, 0])
+
+        # Cascaded post-refinement-1 and -2
+        for _ in range(2):
+            logits, iou_predictions = self._decode(
+                coords_torch, labels_torch, box, logit, True
+            )
+            best_idx = int(iou_predictions[0].argmax())
+            logit = logits[:, best_idx : best_idx + 1]
+            box = self._low_res_box(logit[0, 0])
+
+        mask = self.model.postprocess_masks(logit, self.input_size, self.original_size)
+        mask = (mask[0, 0] > self.model.mask_threshold).cpu().numpy()
+        return mask, float(iou_predictions[0, best_idx]), best_idx
+
+    def _low_res_box(self, low_res_logits: torch.Tensor) -> Optional[torch.Tensor]:
+        """
+        The box around a low resolution mask (HxW logits) as 1x4 tensor in
+        XYXY format in the input frame, or None if the mask is empty.
+        """
+        scale = self.model.image_encoder.img_size / low_res_logits.shape[-1]
+        valid = low_res_logits[
+            : int(np.ceil(self.input_size[0] / scale)), : int(np.ceil(self.input_size[1] / scale))
+        ]
+        y, x = torch.nonzero(valid > self.model.mask_threshold, as_tuple=True)
+        if len(y) == 0:
+            return None
+        # A low res pixel covers scale x scale pixels of the input frame
+        box = torch.stack([
+            x.min() * scale,
+            y.min() * scale,
+            torch.clamp((x.max() + 1) * scale - 1, max=self.input_size[1] - 1),
+            torch.clamp((y.max() + 1) * scale - 1, max=self.input_size[0] - 1),
+        ])
+        return box.float()[None, :]
 
     def get_image_embedding(self) -> torch.Tensor:
         """
@@ -282,6 +632,17 @@ class SamPredictor:
         assert self.features is not None, "Features must exist if an image has been set."
         return self.features
 
+    def _load_cached_embedding(self, cache_key: str) -> bool:
+        """Sets the image from the embedding cache. Returns False on a cache miss."""
+        cached = self.embedding_cache.load(cache_key, self.device)
+        if cached is None:
+            return False
+        features, input_size, original_size = cached
+        self.set_embedding(
+            {"features": features, "input_size": input_size, "original_size": original_size}
+        )
+        return True
+
     @property
     def device(self) -> torch.device:
         return self.model.device
@@ -0,0 +1,105 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import hashlib
+import os
+from typing import Optional, Tuple, Union
+
+
+class EmbeddingCache:
+    """
+    A persistent, content addressed store for SAM image embeddings. Entries
+    are keyed by a hash of the image content, the checkpoint name and the
+    encoder input size, so an image is encoded only once per checkpoint no
+    matter how often or from which script it is set.
+    """
+
+    def __init__(self, cache_dir: str, checkpoint: str) -> None:
+        """
+        Arguments:
+          cache_dir (str): Directory the embeddings are stored in. It is
+            created if it does not exist.
+          checkpoint (str): Name of the checkpoint the embeddings were
+            computed with, e.g. 'sam_vit_h_4b8939.pth'.
+        """
+        self.cache_dir = cache_dir
+        self.checkpoint = os.path.basename(checkpoint)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(
+        self,
+        image: Union[np.ndarray, torch.Tensor],
+        img_size: int,
+        original_size: Optional[Tuple[int, ...]] = None,
+    ) -> str:
+        """
+        Computes the cache key for an image.
+
+        Arguments:
+          image (np.ndarray or torch.Tensor): The image as it is handed to
+            SamPredictor, either the HWC numpy image or the transformed
+            1x3xHxW torch tensor.
+          img_size (int): The input size of the image encoder.
+          original_size (tuple(int, int) or None): The original image size,
+            needed for transformed tensors where it cannot be derived from
+            the image itself.
+
+        Returns:
+          (str): The key, usable as a file name.
+        """
+        if isinstance(image, torch.Tensor):
+            image = image.detach().cpu().numpy()
+        image = np.ascontiguousarray(image)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{image.shape}{image.dtype}{original_size}".encode())
+        digest.update(image.data)
+        return f"{self.checkpoint}_{img_size}_{digest.hexdigest()}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def load(
+        self, key: str, device: torch.device
+    ) -> Optional[Tuple[torch.Tensor, Tuple[int, ...], Tuple[int, ...]]]:
+        """
+        Loads an embedding from the cache.
+
+        Returns:
+          (tuple or None): The features in 1xCxHxW format, the input size and
+            the original size, or None if the key is not cached.
+        """
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            entry = torch.load(path, map_location=device)
+        except Exception:
+            # A truncated or otherwise unreadable entry is treated as a miss
+            return None
+        return entry["features"], tuple(entry["input_size"]), tuple(entry["original_size"])
+
+    def save(
+        self,
+        key: str,
+        features: torch.Tensor,
+        input_size: Tuple[int, ...],
+        original_size: Tuple[int, ...],
+    ) -> None:
+        """Stores an embedding together with the sizes needed to postprocess masks."""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(
+            {
+                "features": features.detach().cpu(),
+                "input_size": tuple(input_size),
+                "original_size": tuple(original_size),
+            },
+            tmp_path,
+        )
+        os.replace(tmp_path, path)
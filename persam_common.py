@@ -0,0 +1,179 @@
+import os
+
+import torch
+from tqdm import tqdm
+
+from show import OVERLAY_SIZE, save_overlay, save_verification_images
+from mask_io import write_mask_png
+from image_loader import ImagePrefetcher
+from location_prior import peak_sharpness
+from cascade import TierLog, TIER_NAMES, is_confident
+from per_segment_anything import sam_model_registry, checkpoint_model_type, SamPredictor
+from per_segment_anything.utils.embedding_cache import EmbeddingCache
+
+# Loading SAM and the test loop, shared by PerSAM and PerSAM_F. The two only differ
+# in how a reference becomes a target (load_reference) and how the mask of a target
+# is predicted on a test image (predict_test_mask), the scripts pass these in.
+
+
+def load_predictor(args, ckpt=None):
+    # Other checkpoints than --ckpt, like the screening model of the cascade, get the model type of their name
+    model_type = args.model_type if ckpt is None else None
+    ckpt = ckpt or args.ckpt
+
+    print("\n======> Loading SAM" )
+    model_type = model_type or checkpoint_model_type(ckpt)
+    print(f"Using {model_type} checkpoint: {ckpt}")
+    # The predictor only runs inference, MobileSAM folds its BatchNorm layers into the convolutions
+    build_options = {'fuse': True} if model_type == 'vit_t' else {}
+    sam = sam_model_registry[model_type](checkpoint=os.path.join(args.weights_directory, ckpt), inference_mode=args.inference_mode, **build_options)
+    if args.device == "CUDA":
+        sam = sam.cuda()
+    else:
+        sam = sam.cpu()
+    sam.eval()
+
+    embedding_cache = None
+    if args.embedding_cache:
+        print(f"Using embedding cache in {args.embedding_cache}")
+        # Embeddings of other inference modes differ slightly and are kept apart
+        cache_name = ckpt if sam.inference_mode == 'fp32' else f"{ckpt}.{sam.inference_mode}"
+        embedding_cache = EmbeddingCache(args.embedding_cache, cache_name)
+
+    return SamPredictor(sam, embedding_cache)
+
+
+def load_tiers(args, predictor=None, screening_predictor=None):
+    """The predictors that segment the test images and their checkpoints.
+
+    In cascade mode the screening model comes first and segments every image, the
+    model of --ckpt only the uncertain ones. Otherwise there is just the model of --ckpt.
+    """
+    if predictor is None:
+        predictor = load_predictor(args)
+    tiers = [predictor]
+    if args.cascade_ckpt:
+        tiers.insert(0, screening_predictor or load_predictor(args, args.cascade_ckpt))
+    tier_ckpts = [args.cascade_ckpt, args.ckpt][-len(tiers):]
+    return tiers, tier_ckpts
+
+
+def load_tier_targets(references, tiers, load_reference, input_path, fastsam_input_paths):
+    """The targets of all references for every tier, as the features differ between the models.
+
+    load_reference(reference, predictor, input_path, fastsam_input_path) returns the
+    normalised target feature (1, C) and whatever predict_test_mask needs of the reference.
+    Per tier the target features are stacked (R, C) for scoring all references in one matmul.
+    """
+    tier_targets = []
+    for tier_predictor in tiers:
+        target_feats, reference_targets = [], []
+        for reference, fastsam_input_path in zip(references, fastsam_input_paths):
+            target_feat, reference_target = load_reference(reference, tier_predictor, input_path, fastsam_input_path)
+            target_feats.append(target_feat)
+            reference_targets.append(reference_target)
+        tier_targets.append((torch.cat(target_feats, dim=0), reference_targets))
+    return tier_targets
+
+
+def list_test_images(input_path):
+    test_images = []
+    for test_image in os.listdir(input_path):
+        test_image_path = f"{input_path}/{test_image}"
+        if os.path.isfile(test_image_path):
+            test_images.append(test_image)
+        else:
+            print(f"{test_image_path} is not a file (probably a folder). Skipping.")
+    return test_images
+
+
+def segment_test_images(args, tiers, tier_targets, tier_ckpts, input_path, output_paths, predict_test_mask):
+    """Segments all test images of input_path for every reference and saves the masks to its output path.
+
+    predict_test_mask(predictor, sim, reference_target) returns the mask, the IoU prediction,
+    the index of the mask and the prompt points and labels, for the image set in predictor.
+    """
+    for output_path in output_paths:
+        os.makedirs(output_path, exist_ok=True)
+    tier_log = TierLog(output_paths) if len(tiers) > 1 else None
+
+    print('======> Start Testing')
+    test_images = list_test_images(input_path)
+
+    deferred_images = []
+    # The next images are decoded and resized in the background while the encoder runs
+    loader = iter(ImagePrefetcher(input_path, test_images, tiers[-1].transform, args.loader_threads, 2 * args.encoder_batch_size, args.reduced_decode == 'on'))
+    for batch_start in tqdm(range(0, len(test_images), args.encoder_batch_size)):
+
+        # Load test images
+        batch = [next(loader) for _ in range(min(args.encoder_batch_size, len(test_images) - batch_start))]
+
+        # Masks of all references, with the first tier for every image and the next tier for
+        # the images that have an uncertain mask. Only the uncertain masks are replaced.
+        batch_results = [[None] * len(output_paths) for _ in batch]
+        pending = list(range(len(batch)))
+        for tier, (tier_predictor, (target_feats, reference_targets)) in enumerate(zip(tiers, tier_targets)):
+            if not pending:
+                break
+
+            # Image feature encoding, several images per encoder pass
+            batch_embeddings = tier_predictor.encode_batch([batch[i][2] for i in pending], batch_size=args.encoder_batch_size, original_sizes=[batch[i][3] for i in pending])
+
+            for i, embedding in zip(pending, batch_embeddings):
+                sims = test_similarities(tier_predictor, embedding, target_feats)
+                for r, (sim, reference_target) in enumerate(zip(sims, reference_targets)):
+                    if batch_results[i][r] is None or not is_confident(batch_results[i][r][3], batch_results[i][r][1], args):
+                        sharpness = peak_sharpness(sim[0, 0], tier_predictor.input_size, tier_predictor.model.image_encoder.img_size)
+                        batch_results[i][r] = (tier, sharpness, *predict_test_mask(tier_predictor, sim, reference_target))
+
+            pending = [i for i in pending if not all(is_confident(result[3], result[1], args) for result in batch_results[i])]
+
+        for (test_image_file, test_image, _, _), results in zip(batch, batch_results):
+            test_image_name = test_image_file.strip('.jpg')
+            for r, ((tier, sharpness, final_mask, score, best_idx, topk_xy, topk_label), output_path) in enumerate(zip(results, output_paths)):
+                label = f"Mask {best_idx}"
+                if tier_log is not None:
+                    tier_log.record(r, test_image_file, tier, tier_ckpts[tier], score, sharpness)
+                    label = f"{label} ({TIER_NAMES[tier]})"
+                verification_image = save_test_mask(test_image, test_image_name, final_mask, topk_xy, topk_label, label, output_path, args.verification_images)
+                if args.verification_images == 'deferred':
+                    deferred_images.append((test_image_file, *verification_image))
+
+    if tier_log is not None:
+        tier_log.close()
+
+    if deferred_images:
+        print('======> Saving verification images')
+        save_verification_images(input_path, deferred_images)
+
+
+def test_similarities(predictor, embedding, target_feats):
+    # Cosine similarity against all references at once, R similarity maps (1, 1, h, w)
+    predictor.set_embedding(embedding)
+    test_feat = predictor.features.squeeze()
+    C, h, w = test_feat.shape
+    test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
+    test_feat = test_feat.reshape(C, h * w)
+    sims = target_feats @ test_feat
+    return sims.reshape(-1, 1, 1, h, w)
+
+
+def save_test_mask(test_image, test_image_name, final_mask, topk_xy, topk_label, label, output_path, verification_images='on'):
+
+    # Save masks
+    masks_output_folder = os.path.join(output_path, 'Masks')
+    if not os.path.exists(masks_output_folder):
+        os.makedirs(masks_output_folder, exist_ok=True)
+    mask_output_path = os.path.join(masks_output_folder,  f'{test_image_name}.png')
+    write_mask_png(mask_output_path, final_mask)
+
+    # Verification image, drawn right away or handed back to be drawn later
+    if verification_images == 'off':
+        return None
+    vis_mask_output_folder = os.path.join(output_path, 'Images')
+    if not os.path.exists(vis_mask_output_folder):
+        os.makedirs(vis_mask_output_folder, exist_ok=True)
+    vis_mask_output_path = os.path.join(vis_mask_output_folder,  f'vis_mask_{test_image_name}.jpg')
+    if verification_images == 'on':
+        save_overlay(vis_mask_output_path, test_image.for_size(OVERLAY_SIZE), final_mask, topk_xy, topk_label, label)
+    return vis_mask_output_path, mask_output_path, topk_xy, topk_label, label
@@ -3,6 +3,11 @@ import torch
 import matplotlib.pyplot as plt
 import cv2
 
+from mask_io import read_mask_png
+from image_loader import read_image
+
+# Longest side of the verification images
+OVERLAY_SIZE = 1000
 
 
 def show_mask(mask, ax, random_color=False):
@@ -25,4 +30,39 @@ def show_points(coords, labels, ax, marker_size=375):
 def show_box(box, ax):
     x0, y0 = box[0], box[1]
     w, h = box[2] - box[0], box[3] - box[1]
-    ax.add_patch(plt.Rectangle((x0, y0), w, h, edgecolor='green', facecolor=(0,0,0,0), lw=2)) 
\ No newline at end of file
+    ax.add_patch(plt.Rectangle((x0, y0), w, h, edgecolor='green', facecolor=(0,0,0,0), lw=2)) 
+
+def render_overlay(image, mask, coords, labels, title=None, image_format='RGB', max_size=OVERLAY_SIZE):
+    # Same look as show_mask and show_points, drawn with OpenCV on a downscaled BGR copy of the image
+    h, w = mask.shape[-2:]
+    scale = min(1.0, max_size / max(h, w))
+    size = (round(w * scale), round(h * scale))
+    overlay = cv2.resize(image, size, interpolation=cv2.INTER_AREA) if scale < 1.0 else image.copy()
+    mask = cv2.resize(mask.astype(np.uint8), size, interpolation=cv2.INTER_NEAREST) > 0 if scale < 1.0 else mask.astype(bool)
+    if image_format == 'RGB':
+        overlay = cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR)
+
+    overlay[mask] = (0.6 * overlay[mask] + 0.4 * np.array([255, 144, 30])).astype(np.uint8)
+
+    marker_size = max(12, round(max(size) / 40))
+    for (x, y), label in zip(coords, labels):
+        center = (round(x * scale), round(y * scale))
+        color = (0, 128, 0) if label == 1 else (0, 0, 255)
+        cv2.drawMarker(overlay, center, (255, 255, 255), cv2.MARKER_STAR, marker_size, thickness=5)
+        cv2.drawMarker(overlay, center, color, cv2.MARKER_STAR, marker_size, thickness=2)
+
+    if title is not None:
+        cv2.putText(overlay, title, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 4, cv2.LINE_AA)
+        cv2.putText(overlay, title, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2, cv2.LINE_AA)
+    return overlay
+
+
+def save_overlay(output_path, image, mask, coords, labels, title=None, image_format='RGB'):
+    cv2.imwrite(output_path, render_overlay(image, mask, coords, labels, title, image_format))
+
+
+def save_verification_images(input_path, deferred_images):
+    # Verification images put off by the test loops, the masks are read back from their PNGs
+    for test_image_file, vis_mask_output_path, mask_output_path, coords, labels, title in deferred_images:
+        image, _ = read_image(f"{input_path}/{test_image_file}", OVERLAY_SIZE)
+        save_overlay(vis_mask_output_path, image, read_mask_png(mask_output_path), coords, labels, title)
@@ -0,0 +1,73 @@
+import csv
+import hashlib
+import io
+import json
+import os
+import sqlite3
+
+class StateStore(object):
+    """Keeps the rows of the instruction CSVs and their step status in one SQLite file.
+
+    Rows are stored per target in the order of the CSV, together with their image name.
+    Every update is its own transaction, so after a crash the store holds exactly the
+    steps that were finished. The CSV is only written when it is exported.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS rows (target TEXT, position INTEGER, image TEXT, data TEXT, PRIMARY KEY (target, position))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS csv_files (target TEXT PRIMARY KEY, fieldnames TEXT, digest TEXT)')
+
+    def close(self):
+        self.connection.close()
+
+    def load_csv(self, target, csv_path):
+        """Reads the CSV of a target into the store.
+
+        If the CSV is still the one the store exported last, the store is newer or equal
+        and is kept, e.g. after a crash. A CSV that was edited or is new replaces the rows
+        of the target. Returns True if the CSV was read.
+        """
+        with open(csv_path, 'rb') as csv_file:
+            content = csv_file.read()
+        digest = hashlib.sha1(content).hexdigest()
+        known = self.connection.execute('SELECT digest FROM csv_files WHERE target = ?', (target,)).fetchone()
+        if known is not None and known[0] == digest:
+            return False
+
+        reader = csv.DictReader(io.StringIO(content.decode('utf-8-sig'), newline=''), dialect='excel', delimiter=';')
+        rows = list(reader)
+        with self.connection:
+            self.connection.execute('DELETE FROM rows WHERE target = ?', (target,))
+            self.connection.executemany('INSERT INTO rows VALUES (?, ?, ?, ?)', [(target, position, row['image'], json.dumps(row)) for position, row in enumerate(rows)])
+            self.connection.execute('INSERT OR REPLACE INTO csv_files VALUES (?, ?, ?)', (target, json.dumps(reader.fieldnames), digest))
+        return True
+
+    def rows(self, target):
+        """All rows of a target as dicts, in the order of the CSV."""
+        return [json.loads(data) for (data,) in self.connection.execute('SELECT data FROM rows WHERE target = ? ORDER BY position', (target,))]
+
+    def update(self, target, position, **fields):
+        """Updates fields of one row in a single transaction. Values are stored as in the CSV, as strings."""
+        with self.connection:
+            (data,) = self.connection.execute('SELECT data FROM rows WHERE target = ? AND position = ?', (target, position)).fetchone()
+            row = json.loads(data)
+            row.update({key: str(value) for key, value in fields.items()})
+            self.connection.execute('UPDATE rows SET data = ? WHERE target = ? AND position = ?', (json.dumps(row), target, position))
+        return row
+
+    def export_csv(self, target, csv_path, tmp_path):
+        """Writes the rows of a target to csv_path. The file is written to tmp_path first and then moved."""
+        (fieldnames,) = self.connection.execute('SELECT fieldnames FROM csv_files WHERE target = ?', (target,)).fetchone()
+        buffer = io.StringIO(newline='')
+        writer = csv.DictWriter(buffer, fieldnames=json.loads(fieldnames), dialect='excel', delimiter=';')
+        writer.writeheader()
+        writer.writerows(self.rows(target))
+        content = buffer.getvalue().encode('utf-8-sig')
+        with open(tmp_path, 'wb') as csv_file:
+            csv_file.write(content)
+        os.replace(tmp_path, csv_path)
+        with self.connection:
+            self.connection.execute('UPDATE csv_files SET digest = ? WHERE target = ?', (hashlib.sha1(content).hexdigest(), target))
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from image_loader import read_image, read_input_image
+from per_segment_anything.utils.transforms import ResizeLongestSide
+
+
+@pytest.mark.parametrize('orientation', [1, 3, 6, 8])
+def test_reduced_decode_keeps_exif_orientation(tmp_path, orientation):
+    # A 1200 x 3000 scan, stored with an EXIF orientation
+    image_path = str(tmp_path / 'rotated.jpg')
+    image = Image.fromarray(np.zeros((1200, 3000, 3), dtype=np.uint8))
+    exif = image.getexif()
+    exif[0x0112] = orientation
+    image.save(image_path, exif=exif)
+
+    full_image, full_size = read_image(image_path)
+    reduced_image, reduced_size = read_image(image_path, 1024)
+    assert tuple(full_size) == full_image.shape[:2]
+    assert tuple(reduced_size) == tuple(full_size)
+    # The reduced image has the orientation and aspect of the full one
+    assert reduced_image.shape[0] * 2 == full_image.shape[0] and reduced_image.shape[1] * 2 == full_image.shape[1]
+
+    transform = ResizeLongestSide(1024)
+    input_image, original_size = read_input_image(image_path, transform)
+    assert input_image.shape[:2] == transform.get_preprocess_shape(*full_size, 1024)
+    assert tuple(original_size) == tuple(full_size)
@@ -0,0 +1,19 @@
+import pytest
+
+pytest.importorskip('clip')
+
+from utils.tools import convert_box_xywh_to_xyxy
+
+
+def test_convert_single_box():
+    assert convert_box_xywh_to_xyxy([10, 20, 30, 40]) == [10, 20, 40, 60]
+
+
+def test_convert_four_boxes():
+    # Four boxes must not be taken for the four values of one box
+    boxes = [[0, 0, 1, 1], [10, 10, 5, 5], [20, 0, 2, 3], [1, 2, 3, 4]]
+    assert convert_box_xywh_to_xyxy(boxes) == [[0, 0, 1, 1], [10, 10, 15, 15], [20, 0, 22, 3], [1, 2, 4, 6]]
+
+
+def test_convert_two_boxes():
+    assert convert_box_xywh_to_xyxy([[0, 0, 1, 1], [10, 10, 5, 5]]) == [[0, 0, 1, 1], [10, 10, 15, 15]]
@@ -9,14 +9,14 @@ import clip
 
 
 def convert_box_xywh_to_xyxy(box):
-    if len(box) == 4:
-        return [box[0], box[1], box[0] + box[2], box[1] + box[3]]
-    else:
+    # A list of boxes is converted box by box, also when it holds exactly four boxes
+    if isinstance(box[0], (list, tuple)):
         result = []
         for b in box:
             b = convert_box_xywh_to_xyxy(b)
-            result.append(b)               
-    return result
+            result.append(b)
+        return result
+    return [box[0], box[1], box[0] + box[2], box[1] + box[3]]
 
 
 def segment_image(image, bbox):